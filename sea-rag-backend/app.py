@@ -1,21 +1,30 @@
 from fastapi import FastAPI, UploadFile, File, Query, Body, BackgroundTasks, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
+
+# sse-starlette 负责 SSE 帧组装与 keep-alive ping；缺失时退回手动组帧
+try:
+    from sse_starlette.sse import EventSourceResponse
+except ImportError:
+    EventSourceResponse = None
 from pydantic import BaseModel
-import asyncio, time, os, random, string, json
+import asyncio, time, os, random, string
+import io
+import re as regex_module
+import aiofiles
 import fitz
 from typing import Optional, Dict, Any, List
 from pathlib import Path
 
 # 导入我们的 Service 模块
 from services.pdf_service import (
-    save_upload_file, convert_pdf_to_markdown,
-    get_original_pdf_path, get_images_dir,
+    register_upload_file, convert_pdf_to_markdown,
     get_original_pdf_path, get_images_dir,
     render_parsed_page, delete_file
 )
 from services.index_service import build_faiss_index, search_faiss
-from services.rag_service import retrieve, answer_stream, clear_history
+from services.rag_service import retrieve, answer_stream, clear_history, warmup as rag_warmup
+from services import jsonio
 
 app = FastAPI(
     title="Sea-RAG API",
@@ -34,6 +43,21 @@ app.add_middleware(
 
 API_PREFIX = "/api/v1"
 
+# 预热任务的强引用：事件循环对 Task 只存弱引用，不持有的话
+# 任务可能在完成前被 GC（asyncio 文档明确警告）
+_WARMUP_TASK = None
+
+@app.on_event("startup")
+async def _startup_warmup():
+    # 后台预热 RAG（embedding 模型 + 全局索引），不阻塞服务就绪
+    global _WARMUP_TASK
+    _WARMUP_TASK = asyncio.create_task(rag_warmup())
+
+# SSE 帧的固定片段（bytes 常量，避免每个 token 重新分配/编码小字符串）
+_SSE_EVT_PREFIX = b"event: "
+_SSE_DATA_PREFIX = b"\ndata: "
+_SSE_FRAME_END = b"\n\n"
+
 # ---------------- 内存态存储 (Memory State) ----------------
 # [Mock] 用于简单演示单个 PDF 的处理状态。
 # 在生产环境或多用户场景中，应使用 Redis 或数据库持久化任务状态。
@@ -67,10 +91,16 @@ class ChatRequest(BaseModel):
     sessionId: Optional[str] = None
     pdfFileId: Optional[str] = None
 
+# 寒暄/客套话直接跳过检索（省一次 embedding + ANN 搜索）
+_GREETING_RE = regex_module.compile(
+    r"^(你好|您好|嗨|哈喽|hi|hello|hey|谢谢|多谢|thanks|thank you|再见|拜拜|bye|ok|好的)[\s!！?？。.~]*$",
+    regex_module.IGNORECASE
+)
+
 @app.post(f"{API_PREFIX}/chat", tags=["Chat"])
 async def chat_stream(req: ChatRequest):
     """
-    SSE 事件：token | citation | done | error
+    SSE 事件：token | citations | done | error
     """
     async def gen():
         try:
@@ -80,29 +110,34 @@ async def chat_stream(req: ChatRequest):
 
             citations, context_text = [], ""
             branch = "no_context"
-            
+            grader_task = None
+
             # 尝试检索
             # 修改逻辑：默认为 Global RAG；如果传了 file_id 则为 Single Doc RAG
-            # 只有当明确不需要 RAG 时（例如纯聊天模式，暂未实现）才跳过
-            should_retrieve = True 
-            
+            # 过短的消息或寒暄（问候/致谢）不值得付出一次 embedding + FAISS 搜索。
+            # 长度下限区分文种：ASCII 六字符以下基本是 "ok"/"thx" 类；
+            # CJK 信息密度高，四字查询（如「声呐校准」）已是正经领域
+            # 问题，只拦单字符，寒暄主要靠上面的正则
+            min_len = 6 if question.isascii() else 2
+            should_retrieve = len(question) >= min_len and not _GREETING_RE.match(question)
+            if not should_retrieve:
+                print(f"[Chat] 跳过检索 (chit-chat): {question!r}")
+
             if should_retrieve:
                 try:
                     # retrieve 内部 logic: if file_id is None, it ignores filter (Global Search)
-                    citations, context_text = await retrieve(question, file_id if file_id else None)
+                    # grader_task：边界分数时的 LLM 裁决后台任务，
+                    # 由 answer_stream 在引用推送之后再 await（与推流重叠）
+                    citations, context_text, grader_task = await retrieve(question, file_id if file_id else None)
                     branch = "with_context" if context_text else "no_context"
                 except Exception as e:
                     print(f"Retrieval error: {e}")
                     branch = "no_context"
 
-            # 先推送引用（若有）
+            # 先推送引用（若有）：整个数组一次编码、一个事件发出，
+            # 省掉每条引用一次 JSON 编码 + 一次 socket 写
             if branch == "with_context" and citations:
-                for c in citations:
-                    # 确保 JSON 序列化
-                    import json
-                    c_json = json.dumps(c, ensure_ascii=False)
-                    yield f"event: citation\n"
-                    yield f"data: {c_json}\n\n"
+                yield {"event": "citations", "data": jsonio.dumps_str(citations)}
 
             # 再推送 token 流（内部会写入历史）
             async for evt in answer_stream(
@@ -110,29 +145,34 @@ async def chat_stream(req: ChatRequest):
                 citations=citations,
                 context_text=context_text,
                 branch=branch,
-                session_id=session_id
+                session_id=session_id,
+                grader_task=grader_task
             ):
                 if evt["type"] == "token":
-                    yield "event: token\n"
-                    # 注意：这里确保 data 是合法 JSON 字符串
-                    text = evt["data"].replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
-                    yield f'data: {{"text":"{text}"}}\n\n'
-                elif evt["type"] == "citation":
-                    # rag_service 也会 yield citation，这里可能会重复，前端需去重或只取一处
-                    # 这里选择再次发送也没关系，或者忽略
-                    pass
+                    # jsonio 优先走 orjson（Rust 编码器，比 stdlib 快数倍），
+                    # 高 QPS 下逐事件编码的 CPU 占比可观
+                    yield {"event": "token", "data": jsonio.dumps_str({"text": evt["data"]})}
                 elif evt["type"] == "done":
-                    used = "true" if evt["data"].get("used_retrieval") else "false"
-                    yield "event: done\n"
-                    yield f"data: {{\"used_retrieval\": {used}}}\n\n"
+                    used = bool(evt["data"].get("used_retrieval"))
+                    yield {"event": "done", "data": jsonio.dumps_str({"used_retrieval": used})}
 
         except Exception as e:
-            yield "event: error\n"
-            esc = str(e).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
-            yield f'data: {{"message":"{esc}"}}\n\n'
+            yield {"event": "error", "data": jsonio.dumps_str({"message": str(e)})}
 
     headers = {"Cache-Control": "no-cache, no-transform", "Connection": "keep-alive"}
-    return StreamingResponse(gen(), media_type="text/event-stream", headers=headers)
+
+    if EventSourceResponse is not None:
+        # 库负责组帧 + 周期 ping（防止代理超时断流）
+        return EventSourceResponse(gen(), ping=15, headers=headers)
+
+    # 退路：手动拼 SSE 帧（直接产出 bytes，StreamingResponse 不再逐帧编码）
+    async def sse_frames():
+        async for e in gen():
+            yield (_SSE_EVT_PREFIX + e["event"].encode("ascii")
+                   + _SSE_DATA_PREFIX + e["data"].encode("utf-8")
+                   + _SSE_FRAME_END)
+
+    return StreamingResponse(sse_frames(), media_type="text/event-stream", headers=headers)
 
 # ---------------- Chat: 清除对话 ----------------
 class ClearChatRequest(BaseModel):
@@ -141,7 +181,8 @@ class ClearChatRequest(BaseModel):
 @app.post(f"{API_PREFIX}/chat/clear", tags=["Chat"])
 async def chat_clear(req: ClearChatRequest):
     sid = (req.sessionId or "default").strip()
-    clear_history(sid)
+    # Redis 模式下是一次同步 DELETE 往返，不能压在事件循环上
+    await asyncio.to_thread(clear_history, sid)
     return {"ok": True, "sessionId": sid, "cleared": True}
 
 
@@ -153,11 +194,16 @@ async def pdf_upload(file: UploadFile = File(...), replace: Optional[bool] = Tru
     
     # 生成新的 fileId
     fid = rid("f")
-    content = await file.read()
-    
-    # 调用 PDF Service 保存
-    saved_info = save_upload_file(fid, content, file.filename)
-    
+
+    # 分块流式写盘：大 PDF 不再整体进内存，也不阻塞事件循环
+    dest = get_original_pdf_path(fid)
+    async with aiofiles.open(dest, "wb") as out:
+        while chunk := await file.read(1 << 20):
+            await out.write(chunk)
+
+    # 登记元数据（页数从落盘文件读取）
+    saved_info = register_upload_file(fid, file.filename)
+
     # 更新全局状态
     current_pdf_state.update({
         "fileId": fid,
@@ -179,8 +225,13 @@ class ParseRequest(BaseModel):
     fileId: Optional[str] = None  # 调试时可不填，默认使用当前最新上传的文件
 
 # ---------------- PDF: 触发解析 ----------------
+# 解析任务专用线程池：convert_pdf_to_markdown 是十几秒量级的同步阻塞调用，
+# 放到独立线程执行，避免占用 ASGI 事件循环或请求工作线程
+from concurrent.futures import ThreadPoolExecutor
+_PARSE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-parse")
+
 @app.post(f"{API_PREFIX}/pdf/parse", tags=["PDF"])
-async def pdf_parse(req: ParseRequest, bg: BackgroundTasks = None):
+async def pdf_parse(req: ParseRequest):
     # 逻辑：如果请求没传 fileId，或者传的是 Swagger 默认的 "string"，则回退
     file_id = req.fileId
     if not file_id or file_id.strip() == "" or file_id.lower() == "string":
@@ -219,10 +270,9 @@ async def pdf_parse(req: ParseRequest, bg: BackgroundTasks = None):
             current_pdf_state["errorMsg"] = str(e)
             print(f"Parse job error: {e}")
 
-    if bg is not None:
-        bg.add_task(_job)
-    else:
-        _job()
+    # 立即返回 jobId，解析在线程池中进行（状态通过 /pdf/status 轮询）
+    loop = asyncio.get_running_loop()
+    loop.run_in_executor(_PARSE_POOL, _job)
 
     return {"jobId": rid("j"), "fileId": file_id, "status": "started"}
 
@@ -251,55 +301,80 @@ async def pdf_status(fileId: Optional[str] = Query(None)):
 # ---------------- PDF: 页面预览（原始图/解析图） ----------------
 # 注意：v2版本中我们目前只支持从 original 生成的图片预览
 # 这里提供一个简化版，直接返回 original 页面图片
+
+# 保持打开状态的 fitz.Document 池（LRU，避免每次请求重新解析 xref 表）
+from collections import OrderedDict
+_DOC_CACHE: "OrderedDict[str, Any]" = OrderedDict()
+_DOC_CACHE_SIZE = 8
+
+def _get_cached_doc(file_id: str):
+    """按 fileId 复用已打开的 fitz.Document；淘汰时显式 close"""
+    doc = _DOC_CACHE.get(file_id)
+    if doc is not None:
+        _DOC_CACHE.move_to_end(file_id)
+        return doc
+    pdf_path = get_original_pdf_path(file_id)
+    if not pdf_path.exists():
+        return None
+    doc = fitz.open(pdf_path)
+    _DOC_CACHE[file_id] = doc
+    if len(_DOC_CACHE) > _DOC_CACHE_SIZE:
+        _, old = _DOC_CACHE.popitem(last=False)
+        old.close()
+    return doc
+
+def _drop_cached_doc(file_id: str):
+    doc = _DOC_CACHE.pop(file_id, None)
+    if doc is not None:
+        doc.close()
+
 @app.get(f"{API_PREFIX}/pdf/page", tags=["PDF"])
 async def pdf_page(
     fileId: str = Query(...),
     page: int = Query(..., ge=1),
     type: str = Query("original") # original | parsed
 ):
-    # 此处简化处理：无论是 original 还是 parsed，都返回 images 目录下的对应页图片
-    # 因为我们的 pdf_service.py 中 convert_pdf_to_markdown 会生成每个页面的截图
-    
-    # 验证 fileId
-    # if current_pdf_state["fileId"] != fileId: ... (可选校验)
+    # 渲染结果落盘缓存：同一页重复预览直接走静态文件，
+    # 免去 MuPDF 重复解码/光栅化（2x 缩放下每页数十毫秒）
+    cache = Path("data") / fileId / "preview" / f"page-{page}_{type}.png"
+    if cache.exists():
+        return FileResponse(str(cache), media_type="image/png")
 
-    # 图片命名规则: page{page}_img1.png? 不，PyMuPDF生成的是 page-0001.png 这种格式比较好管理
-    # 但 pdf_service.py 目前逻辑是提取内嵌图片...
-    # 为了支持页面预览，我们需要 pdf_service.py 支持“渲染整页为图片”
-    # 幸好我们有原始 PDF，可以实时渲染（或者预先渲染）
-    
     if type == "parsed":
         # 调用 pdf_service 的渲染函数
         # 注意：这需要 PDF 已经通过 parse 流程生成了 segments.json
         img_bytes = render_parsed_page(fileId, page)
         if img_bytes:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            cache.write_bytes(img_bytes)
             return StreamingResponse(io.BytesIO(img_bytes), media_type="image/png")
         else:
             # 如果没有解析结果（比如还没解析），暂时回退到原始图，或者返回 404
-            # return JSONResponse(err("PARSED_NOT_READY", "解析结果未就绪"), status_code=404)
+            # 注意：回退渲染不要写入 parsed 缓存，否则解析完成后会一直返回旧图
             pass # 继续下面逻辑，作为 fallback 显示原始图
 
-    # 这里为了演示简单，我们实时渲染一帧（性能较低但够用）
-    import fitz
     try:
-        pdf_path = get_original_pdf_path(fileId)
-        if not pdf_path.exists():
+        doc = _get_cached_doc(fileId)
+        if doc is None:
             return JSONResponse(err("FILE_NOT_FOUND", "PDF 文件不存在"), status_code=404)
-            
-        doc = fitz.open(pdf_path)
         if page > len(doc):
             return JSONResponse(err("PAGE_OUT_OF_RANGE", "页码超出范围"), status_code=404)
-            
+
         # 渲染指定页
         pix = doc[page-1].get_pixmap(matrix=fitz.Matrix(2, 2)) # 2x 缩放清晰度
         img_bytes = pix.tobytes("png")
-        
+
+        if type == "original":
+            cache.parent.mkdir(parents=True, exist_ok=True)
+            cache.write_bytes(img_bytes)
+
         return StreamingResponse(io.BytesIO(img_bytes), media_type="image/png")
     except Exception as e:
         return JSONResponse(err("RENDER_ERROR", str(e)), status_code=500)
 
-import io
-import re as regex_module
+# 页图片命名规则: page{N}_img{M}.{ext}；预编译避免每个文件重复 compile/search
+# 扩展名放宽到字母数字：零转码提取会按 PDF 内嵌格式落盘（jpeg/jpx/tiff 等）
+_PAGE_IMG_RE = regex_module.compile(r"^page(\d+)_img(\d+)\.([a-z0-9]{2,5})$", regex_module.IGNORECASE)
 
 # ---------------- PDF: 获取某页的图片列表 ----------------
 @app.get(f"{API_PREFIX}/pdf/page-images", tags=["PDF"])
@@ -309,22 +384,23 @@ async def pdf_page_images(
 ):
     """获取指定文件指定页面的所有图片文件名列表"""
     img_dir = get_images_dir(fileId)
-    
+
     if not img_dir.exists():
         return {"images": []}
-    
-    # 查找该页的所有图片 (格式: page{N}_img{M}.png)
-    pattern = regex_module.compile(rf"^page{page}_img\d+\.(png|jpg|jpeg|gif|webp)$", regex_module.IGNORECASE)
+
+    # 单次扫描：匹配时顺手捕获图片编号，排序键无需再跑正则
+    # os.scandir 一次 getdents 批量取目录项，免去逐文件 stat
     images = []
-    
-    for f in img_dir.iterdir():
-        if f.is_file() and pattern.match(f.name):
-            images.append(f.name)
-    
-    # 按图片编号排序
-    images.sort(key=lambda x: int(regex_module.search(r"img(\d+)", x).group(1)) if regex_module.search(r"img(\d+)", x) else 0)
-    
-    return {"images": images}
+    with os.scandir(img_dir) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            m = _PAGE_IMG_RE.match(entry.name)
+            if m and int(m.group(1)) == page:
+                images.append((int(m.group(2)), entry.name))
+
+    images.sort()
+    return {"images": [name for _, name in images]}
 
 # ---------------- PDF: 获取提取的图片（Markdown 中引用的） ----------------
 @app.get(f"{API_PREFIX}/pdf/images", tags=["PDF"])
@@ -358,99 +434,124 @@ async def index_build(req: IndexBuildRequest):
     return res
 
 class IndexSearchRequest(BaseModel):
-    fileId: str
+    fileId: Optional[str] = None
     query: str
     k: int = 5
+    nprobe: Optional[int] = None  # IVF 索引扫描聚类数（召回/延迟权衡）
 
 @app.post(f"{API_PREFIX}/index/search", tags=["Index"])
 async def index_search(req: IndexSearchRequest):
-    res = search_faiss(req.fileId, req.query, req.k)
+    filters = {"file_id": req.fileId} if req.fileId else None
+    res = search_faiss(req.query, filters=filters, k=req.k, nprobe=req.nprobe)
     if not res.get("ok"):
         return JSONResponse(err("INDEX_SEARCH_FAIL", res.get("error", "unknown")), status_code=500)
     return res
 
 # ---------------- Files: 列表查询 ----------------
+# 列表结果缓存：以 data 目录 + 各子目录 mtime 为签名，
+# 上传/解析/删除都会改动对应目录的 mtime，从而自动失效
+_FILES_CACHE: Dict[str, Any] = {"sig": None, "data": None}
+
+def _repair_meta(item_path: str, fid: str, meta_path: Path,
+                 display_name: str, upload_time: float, page_count: int):
+    """meta.json 缺页数/时间时的兜底修复（仅在确实缺失时触发）"""
+    pdf_path = Path(item_path) / "original.pdf"
+    if not pdf_path.exists():
+        return display_name, upload_time, page_count
+
+    if upload_time == 0:
+        upload_time = os.stat(item_path).st_mtime
+
+    if page_count == 0:
+        # 走文档池：page_count 只需解析 xref 表（无页面解码），
+        # 池内命中时连 xref 解析都省掉。正常路径下页数在上传时就已写入 meta.json，
+        # 这里只兜底手工拷贝进 data 目录的文件
+        try:
+            doc = _get_cached_doc(fid)
+            if doc is not None:
+                page_count = doc.page_count
+        except:
+            pass
+
+    new_meta = {
+        "id": fid,
+        "original_filename": display_name,
+        "upload_time": upload_time,
+        "page_count": page_count,
+        "size_bytes": pdf_path.stat().st_size
+    }
+    # 如果原meta存在，保留其他字段
+    if meta_path.exists():
+        try:
+            existing_meta = jsonio.loads(meta_path.read_bytes())
+            existing_meta.update(new_meta)
+            new_meta = existing_meta
+        except:
+            pass
+
+    meta_path.write_bytes(jsonio.dumps_bytes(new_meta, indent=True))
+    return display_name, upload_time, page_count
+
 @app.get(f"{API_PREFIX}/files/list", tags=["Files"])
 async def files_list():
     """获取知识库文件列表"""
     data_root = Path("data").resolve()
     if not data_root.exists():
         return {"files": []}
-    
+
+    # os.scandir 一次批量读目录项（自带 is_dir/mtime，无需逐项 stat）
+    entries = []
+    with os.scandir(data_root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False) and entry.name != "global_index":
+                entries.append((entry.name, entry.path, entry.stat(follow_symlinks=False).st_mtime))
+
+    sig = hash(tuple(sorted((name, mtime) for name, _, mtime in entries)))
+    if sig == _FILES_CACHE["sig"] and _FILES_CACHE["data"] is not None:
+        return _FILES_CACHE["data"]
+
     files = []
-    # 遍历 data 目录下的子文件夹
-    for item in data_root.iterdir():
-        if item.is_dir() and item.name != "global_index":
-            fid = item.name
-            
-            # 读取 meta.json
-            meta_path = item / "meta.json"
-            display_name = fid
-            upload_time = 0
-            page_count = 0
-            
-            if meta_path.exists():
-                try:
-                    meta = json.loads(meta_path.read_text(encoding="utf-8"))
-                    display_name = meta.get("original_filename", fid)
-                    upload_time = meta.get("upload_time", 0)
-                    page_count = meta.get("page_count", 0)
-                except:
-                    pass
-            
-            # 如果没有页数或没有时间，尝试修复
-            if page_count == 0 or upload_time == 0:
-                try:
-                    pdf_path = item / "original.pdf"
-                    if pdf_path.exists():
-                        # 获取文件时间作为兜底
-                        file_mtime = item.stat().st_mtime
-                        if upload_time == 0:
-                            upload_time = file_mtime
-                            
-                        # 获取页数
-                        if page_count == 0:
-                            try:
-                                with fitz.open(pdf_path) as doc:
-                                    page_count = doc.page_count
-                            except:
-                                pass
-                        
-                        # 更新/创建 meta.json
-                        new_meta = {
-                            "id": fid,
-                            "original_filename": display_name,
-                            "upload_time": upload_time,
-                            "page_count": page_count,
-                            "size_bytes": pdf_path.stat().st_size
-                        }
-                        # 如果原meta存在，保留其他字段
-                        if meta_path.exists():
-                            try:
-                                existing_meta = json.loads(meta_path.read_text(encoding="utf-8"))
-                                existing_meta.update(new_meta)
-                                new_meta = existing_meta
-                            except:
-                                pass
-                                
-                        meta_path.write_text(json.dumps(new_meta, ensure_ascii=False, indent=2), encoding="utf-8")
-                except Exception as e:
-                    print(f"Error repairing meta for {fid}: {e}")
+    for fid, item_path, _ in entries:
+        # 读取 meta.json
+        meta_path = Path(item_path) / "meta.json"
+        display_name = fid
+        upload_time = 0
+        page_count = 0
+
+        if meta_path.exists():
+            try:
+                meta = jsonio.loads(meta_path.read_bytes())
+                display_name = meta.get("original_filename", fid)
+                upload_time = meta.get("upload_time", 0)
+                page_count = meta.get("page_count", 0)
+            except:
+                pass
+
+        # 如果没有页数或没有时间，尝试修复
+        if page_count == 0 or upload_time == 0:
+            try:
+                display_name, upload_time, page_count = _repair_meta(
+                    item_path, fid, meta_path, display_name, upload_time, page_count)
+            except Exception as e:
+                print(f"Error repairing meta for {fid}: {e}")
+
+        # 判断状态
+        is_indexed = os.path.exists(os.path.join(item_path, "output.md")) # 简单判断是否解析过
+
+        files.append({
+            "id": fid,
+            "name": display_name,
+            "uploadTime": upload_time,
+            "pageCount": page_count,
+            "status": "ready" if is_indexed else "uploaded" # 简化状态
+        })
 
-            # 判断状态
-            is_indexed = (item / "output.md").exists() # 简单判断是否解析过
-            
-            files.append({
-                "id": fid,
-                "name": display_name,
-                "uploadTime": upload_time,
-                "pageCount": page_count,
-                "status": "ready" if is_indexed else "uploaded" # 简化状态
-            })
-            
     # 按时间倒序
     files.sort(key=lambda x: x["uploadTime"], reverse=True)
-    return {"files": files}
+    result = {"files": files}
+    _FILES_CACHE["sig"] = sig
+    _FILES_CACHE["data"] = result
+    return result
 
 # ---------------- Files: 删除文件 ----------------
 @app.delete(f"{API_PREFIX}/files/{{fileId}}", tags=["Files"])
@@ -466,7 +567,9 @@ async def file_delete(fileId: str):
             "progress": 0,
             "errorMsg": None
         })
-        
+    # 释放文档池中的句柄，避免占用已删除文件
+    _drop_cached_doc(fileId)
+
     success = delete_file(fileId)
     if success:
         return {"ok": True, "fileId": fileId}
@@ -489,9 +592,9 @@ async def query_endpoint(req: QueryRequest):
     
     try:
         # 1. 检索
-        citations, context_text = await retrieve(question, req.fileId)
+        citations, context_text, grader_task = await retrieve(question, req.fileId)
         branch = "with_context" if context_text else "no_context"
-        
+
         # 2. 生成 (聚合流式输出)
         answer_parts = []
         async for evt in answer_stream(
@@ -499,7 +602,8 @@ async def query_endpoint(req: QueryRequest):
             citations=citations,
             context_text=context_text,
             branch=branch,
-            session_id=None # 不记录历史，或按需记录
+            session_id=None, # 不记录历史，或按需记录
+            grader_task=grader_task
         ):
             if evt["type"] == "token":
                 answer_parts.append(evt["data"])
@@ -518,5 +622,19 @@ async def query_endpoint(req: QueryRequest):
 
 if __name__ == "__main__":
     import uvicorn
-    # 为了支持开发调试，reload=True
-    uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if os.getenv("APP_RELOAD") == "1":
+        # 开发调试：热重载（单进程）
+        uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
+    else:
+        # loop/http 取 "auto" —— 装了 uvloop/httptools（见 requirements）
+        # 时 uvicorn 自动选用 libuv 事件循环与 C HTTP 解析器，
+        # Windows 等不支持 uvloop 的平台自动退回 asyncio。
+        # 默认单 worker：current_pdf_state、/pdf/status 轮询与
+        # （未配 REDIS_URL 时的）会话历史都是进程内状态，多 worker 下
+        # 轮询会打到没见过任务的进程。已迁移共享存储（REDIS_URL 等）
+        # 的部署可通过 WEB_CONCURRENCY 显式开多 worker。
+        uvicorn.run(
+            "app:app", host="0.0.0.0", port=8000,
+            loop="auto", http="auto",
+            workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        )
\ No newline at end of file
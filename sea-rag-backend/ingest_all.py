@@ -7,12 +7,14 @@ import hashlib
 import argparse
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 # 添加项目根目录到 path 以便导入 services
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from services.pdf_service import convert_pdf_to_markdown, set_data_root as set_pdf_data_root
 from services.index_service import build_faiss_index, set_data_root as set_index_data_root
+from services import jsonio
 
 # ---------------------------------------------------------------------------
 # 配置
@@ -28,16 +30,14 @@ def setup_directories():
 def load_registry() -> dict:
     if REGISTRY_FILE.exists():
         try:
-            with open(REGISTRY_FILE, "r", encoding="utf-8") as f:
-                return json.load(f)
+            return jsonio.loads(REGISTRY_FILE.read_bytes())
         except Exception as e:
             print(f"⚠️ 无法加载注册表，将创建新的: {e}")
             return {}
     return {}
 
 def save_registry(registry: dict):
-    with open(REGISTRY_FILE, "w", encoding="utf-8") as f:
-        json.dump(registry, f, indent=4, ensure_ascii=False)
+    REGISTRY_FILE.write_bytes(jsonio.dumps_bytes(registry, indent=True))
 
 def generate_file_id(filename: str) -> str:
     """
@@ -51,78 +51,72 @@ def generate_file_id(filename: str) -> str:
     safe_id = "".join([c if c.isalnum() or c in "-_" else "_" for c in stem])
     return safe_id
 
-def ingest_one_file(pdf_path: Path, registry: dict, strategy: str = "hi_res", force: bool = False):
+def _parse_worker(task: tuple) -> dict:
+    """
+    子进程工作函数：复制 PDF 并解析为 Markdown（CPU 密集部分）。
+    必须是模块顶层函数（可 pickle），且自行设置 data_root
+    （spawn 的子进程会重新 import 本模块）。
+    返回一个注册表增量 (registry delta)，由父进程串行合并、写盘。
+    """
+    pdf_path_str, file_id, strategy, data_root = task
+    pdf_path = Path(pdf_path_str)
     filename = pdf_path.name
-    print(f"\n[{filename}] 开始处理...")
 
-    # 1. 检查是否已处理
-    # 我们用文件名作为 key 的一部分，或者扫描 registry values?
-    # 简单起见，我们计算 file_id，看是否存在
-    file_id = generate_file_id(filename)
-    
-    if file_id in registry and not force:
-        entry = registry[file_id]
-        if entry.get("status") == "indexed":
-            print(f"  ⏭️  跳过: 已索引 (文件 ID: {file_id})")
-            return
-
-    # 2. 准备工作目录
-    work_dir = DATA_ROOT / file_id
+    set_pdf_data_root(data_root)
+
+    work_dir = Path(data_root) / file_id
     work_dir.mkdir(parents=True, exist_ok=True)
-    
     dest_pdf = work_dir / "original.pdf"
-    
-    # 3. 复制文件
+
+    # 复制文件
     try:
         shutil.copy2(pdf_path, dest_pdf)
-        print(f"  ✅ 文件已复制到: {dest_pdf}")
     except Exception as e:
-        print(f"  ❌ 复制失败: {e}")
-        return
+        return {"file_id": file_id, "ok": False, "entry": {
+            "original_name": filename,
+            "status": "failed_copy",
+            "last_update": datetime.now().isoformat(),
+            "error": str(e),
+        }}
 
-    # 4. 解析 PDF (Markdown + VLM)
+    # 解析 PDF (Markdown + VLM)
     try:
-        print(f"  🔄 正在解析 PDF (策略: {strategy})...")
+        print(f"  🔄 [{filename}] 正在解析 PDF (策略: {strategy})...")
         convert_pdf_to_markdown(file_id, strategy=strategy)
     except Exception as e:
-        print(f"  ❌ 解析失败: {e}")
-        registry[file_id] = {
+        print(f"  ❌ [{filename}] 解析失败: {e}")
+        return {"file_id": file_id, "ok": False, "entry": {
             "original_name": filename,
             "status": "failed_parse",
             "last_update": datetime.now().isoformat(),
-            "error": str(e)
-        }
-        save_registry(registry)
-        return
+            "error": str(e),
+        }}
 
-    # 5. 建立索引
+    return {"file_id": file_id, "ok": True, "entry": {
+        "original_name": filename,
+        "file_id": file_id,
+        "status": "parsed",
+        "last_update": datetime.now().isoformat(),
+        "source_path": str(pdf_path),
+    }}
+
+def index_one_file(file_id: str, entry: dict, registry: dict):
+    """父进程串行建立索引（全局索引是单写者，不能并发追加）并更新注册表"""
     try:
-        print("  🔄 正在建立向量索引...")
+        print(f"  🔄 [{entry.get('original_name')}] 正在建立向量索引...")
         res = build_faiss_index(file_id)
         if not res["ok"]:
             raise Exception(res.get("error"))
         print(f"  ✅ 索引成功! 切片数: {res.get('chunks')}")
+        entry["status"] = "indexed"
     except Exception as e:
         print(f"  ❌ 索引失败: {e}")
-        registry[file_id] = {
-            "original_name": filename,
-            "status": "failed_index",
-            "last_update": datetime.now().isoformat(),
-            "error": str(e)
-        }
-        save_registry(registry)
-        return
+        entry["status"] = "failed_index"
+        entry["error"] = str(e)
 
-    # 6. 更新注册表
-    registry[file_id] = {
-        "original_name": filename,
-        "file_id": file_id,
-        "status": "indexed",
-        "last_update": datetime.now().isoformat(),
-        "source_path": str(pdf_path)
-    }
+    entry["last_update"] = datetime.now().isoformat()
+    registry[file_id] = entry
     save_registry(registry)
-    print("  🎉 处理完成")
 
 def main():
     # 设置全局变量引用，必须在任何使用之前
@@ -133,7 +127,8 @@ def main():
     parser.add_argument("--force", action="store_true", help="强制重新处理已存在的文件")
     parser.add_argument("--strategy", type=str, default="hi_res", choices=["fast", "hi_res"], help="解析策略: fast 或 hi_res (默认: hi_res)")
     parser.add_argument("--data_root", type=str, default="data", help="数据根目录")
-    
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="解析并发进程数 (默认: CPU 核数)")
+
     args = parser.parse_args()
     
     # 更新全局配置
@@ -168,8 +163,31 @@ def main():
     else:
         print(f"发现 {len(pdf_files)} 个 PDF 文件。")
     
+    # 过滤掉已索引的文件
+    tasks = []
     for pdf in pdf_files:
-        ingest_one_file(pdf, registry, strategy=args.strategy, force=args.force)
+        file_id = generate_file_id(pdf.name)
+        if file_id in registry and not args.force:
+            if registry[file_id].get("status") == "indexed":
+                print(f"  ⏭️  跳过: 已索引 (文件 ID: {file_id})")
+                continue
+        tasks.append((str(pdf), file_id, args.strategy, str(DATA_ROOT)))
+
+    if not tasks:
+        return
+
+    # 解析阶段并行（绕开 GIL，多核跑 PyMuPDF/unstructured）；
+    # 索引与注册表写入由父进程串行完成，避免并发写坏全局索引
+    workers = max(1, min(args.workers or 1, len(tasks)))
+    print(f"🔄 并行解析 {len(tasks)} 个文件 (workers={workers})...")
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for delta in ex.map(_parse_worker, tasks, chunksize=1):
+            file_id, entry = delta["file_id"], delta["entry"]
+            if not delta["ok"]:
+                registry[file_id] = entry
+                save_registry(registry)
+                continue
+            index_one_file(file_id, entry, registry)
 
 if __name__ == "__main__":
     main()
@@ -3,13 +3,24 @@ from __future__ import annotations
 from pathlib import Path
 from typing import List, Dict, Any, Optional
 import os
+import math
 import argparse
+import functools
+import hashlib
+import mmap
+import pickle
 import shutil
+import sqlite3
 import re
 
+from concurrent.futures import ThreadPoolExecutor
+
+import faiss
+import numpy as np
+
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
 from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import MarkdownHeaderTextSplitter
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 # LangChain imports
 try:
     from langchain_core.documents import Document
@@ -21,6 +32,8 @@ from langchain_core._api.deprecation import LangChainDeprecationWarning
 warnings.filterwarnings("ignore", category=LangChainDeprecationWarning)
 
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
@@ -31,6 +44,16 @@ load_dotenv(override=True)
 DATA_ROOT = Path(os.getenv("DATA_ROOT", "data")).resolve()
 GLOBAL_INDEX_DIR = DATA_ROOT / "global_index"
 
+# FAISS 索引参数
+# 小语料走精确 Flat；超过该规模后切换到 OPQ+IVF+PQ 压缩索引
+FLAT_FALLBACK_NTOTAL = int(os.getenv("FAISS_FLAT_FALLBACK", "10000"))
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+# 索引类型：auto（按规模选 Flat / OPQ+IVF+PQ）| sq8（IVF + int8 标量量化，4 倍压缩、几乎无损）
+FAISS_INDEX_KIND = os.getenv("FAISS_INDEX_KIND", "auto").lower()
+# 显式 index_factory 串（如 "OPQ32_128,IVF1024,PQ32x8"）：设置后绕过
+# 上面的启发式，便于离线评测不同 OPQ/PQ 组合的召回-压缩权衡
+FAISS_FACTORY = os.getenv("FAISS_FACTORY", "")
+
 def set_data_root(path: str):
     global DATA_ROOT, GLOBAL_INDEX_DIR
     DATA_ROOT = Path(path).resolve()
@@ -59,17 +82,86 @@ def get_original_pdf_name(file_id: str) -> str:
 # ---------------------------------------------------------------------------
 # 嵌入模型 (Embeddings)
 # ---------------------------------------------------------------------------
+# 批量编码大小：GEMM 尺寸的批次能摊薄分词与内核启动开销
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+
+class _ORTBgeEmbeddings:
+    """
+    ONNX Runtime 版 BGE 编码器（CLS 池化 + L2 归一化）。
+    接口与 LangChain Embeddings 兼容（embed_documents / embed_query）。
+    CPU 上配合 int8 量化模型（optimum-cli quantize --avx512_vnni）可达 FP32 的 ~4 倍吞吐。
+    """
+    def __init__(self, model, tokenizer):
+        self._model = model
+        self._tok = tokenizer
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        out = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            enc = self._tok(texts[i:i + EMBED_BATCH_SIZE], padding=True,
+                            truncation=True, max_length=512, return_tensors="np")
+            hidden = self._model(**enc).last_hidden_state
+            cls = np.asarray(hidden[:, 0], dtype=np.float32)
+            cls /= (np.linalg.norm(cls, axis=1, keepdims=True) + 1e-12)
+            out.append(cls)
+        return np.concatenate(out) if out else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+def _load_onnx_embeddings(model_name: str) -> _ORTBgeEmbeddings:
+    """加载 ONNX 推理后端（optimum + onnxruntime）。"""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from transformers import AutoTokenizer
+
+    device = os.getenv("EMBEDDING_DEVICE", "cpu")
+    provider = "CUDAExecutionProvider" if device.startswith("cuda") else "CPUExecutionProvider"
+    kwargs: Dict[str, Any] = {"provider": provider}
+    # 可指向离线量化产物，如 model_quantized.onnx
+    onnx_file = os.getenv("ONNX_MODEL_FILE")
+    if onnx_file:
+        kwargs["file_name"] = onnx_file
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, **kwargs)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    return _ORTBgeEmbeddings(model, tokenizer)
+
+@functools.lru_cache(maxsize=1)
 def load_embeddings():
-    """加载嵌入模型 (BGE 或 OpenAI)"""
+    """加载嵌入模型 (BGE 或 OpenAI)。进程内单例：权重只从磁盘读一次。"""
     # print("[*] 正在加载嵌入模型...")
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-small-zh-v1.5")
+
+    # 可选 ONNX Runtime 后端（EMBEDDING_BACKEND=onnx）：
+    # 算子融合优于 HF 的 Python 胶水层，CPU 上还能用 int8/VNNI 量化模型
+    if os.getenv("EMBEDDING_BACKEND", "hf").lower() == "onnx":
+        try:
+            return _load_onnx_embeddings(model_name)
+        except Exception as e:
+            print(f"⚠️ ONNX 后端加载失败，回退到 HF: {e}")
+
     try:
-        model_name = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-small-zh-v1.5")
+        device = os.getenv("EMBEDDING_DEVICE", "cpu")
+        if device == "cpu":
+            # CPU 推理时吃满所有核心，批量 encode 才能接近线性加速
+            try:
+                import torch
+                torch.set_num_threads(os.cpu_count() or 1)
+            except ImportError:
+                pass
         # 检查本地模型是否存在或直接尝试加载
         embed = HuggingFaceBgeEmbeddings(
-            model_name=model_name, 
-            model_kwargs={'device': 'cpu'}, 
-            encode_kwargs={'normalize_embeddings': True}
+            model_name=model_name,
+            model_kwargs={'device': device},
+            encode_kwargs={'normalize_embeddings': True, 'batch_size': EMBED_BATCH_SIZE}
         )
+        # GPU 上按 BAAI 官方建议启用 FP16：带宽减半、吃满 tensor core，
+        # 吞吐约翻倍且对检索精度几乎无影响（EMBEDDING_FP16=0 可关闭）
+        if device.startswith("cuda") and os.getenv("EMBEDDING_FP16", "1") != "0":
+            embed.client = embed.client.half()
         return embed
     except Exception as e:
         print(f"❌ 本地嵌入加载失败: {e}")
@@ -85,93 +177,421 @@ def load_embeddings():
 # ---------------------------------------------------------------------------
 # 文本切分与元数据注入
 # ---------------------------------------------------------------------------
+# 预编译分页标记：finditer 单遍扫描直接给出 (页码, 位置)，
+# 不像 re.split 捕获组那样为每个被丢弃的 marker 全文再分配一份字符串
+_PAGE_RE = re.compile(r'<!--\s*PAGE_BREAK:\s*(\d+)\s*-->')
+
+# 使用递归字符切分器作为主切分器：相比 HeaderSplitter 对解析不完美的
+# PDF 结构更稳健（不会漏掉引用块等内容）。模块级单例，免去每页一次
+# import + 构造开销
+_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=500,
+    chunk_overlap=50,
+    separators=["\n\n", "\n", " ", ""]
+)
+
+# 可选 Rust 切分后端（semantic-text-splitter，PyO3 绑定）：
+# 按 BGE 分词器的 token 容量切分，整个内层循环在 Rust 里跑，
+# 大 Markdown 上比 Python 递归切分快一个数量级。未安装时静默回退。
+try:
+    from semantic_text_splitter import TextSplitter as _RustTextSplitter
+except ImportError:
+    _RustTextSplitter = None
+
+_RUST_SPLITTER = None
+
+def _get_rust_splitter():
+    """懒初始化 Rust 切分器；分词器加载失败时记一次并永久回退。"""
+    global _RUST_SPLITTER
+    if _RustTextSplitter is None:
+        return None
+    if _RUST_SPLITTER is None:
+        try:
+            from tokenizers import Tokenizer
+            tok = Tokenizer.from_pretrained(
+                os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-small-zh-v1.5"))
+            _RUST_SPLITTER = _RustTextSplitter.from_huggingface_tokenizer(
+                tok, capacity=500, overlap=50)
+        except Exception as e:
+            print(f"⚠️ Rust 切分器初始化失败，回退 LangChain: {e}")
+            _RUST_SPLITTER = False
+    return _RUST_SPLITTER or None
+
 def split_markdown_with_page_tracking(md_text: str, file_id: str, source: str) -> List[Document]:
     """
     切分 Markdown 内容，并注入 'file_id', 'source' 和 'page'（页码）元数据。
     依赖于 pdf_service 注入的 '<!-- PAGE_BREAK: n -->' 标记。
     """
-    
-    # 1. 根据分页标记进行切分
-    # 正则表达式查找 <!-- PAGE_BREAK: (\d+) -->
-    # 我们使用捕获组来保留分隔符，以便知道页码
-    page_splits = re.split(r'(<!--\s*PAGE_BREAK:\s*(\d+)\s*-->)', md_text)
-    
+    # 1. 单遍扫描剥离分页标记，记录每页在“净文本”中的起始偏移。
+    #    第一个标记之前的内容默认属于第 1 页。
+    parts: List[str] = []
+    seg_starts: List[int] = []  # 每段在净文本中的起始偏移
+    seg_pages: List[int] = []
+    prev_end, prev_page, clean_len = 0, 1, 0
+    for m in _PAGE_RE.finditer(md_text):
+        seg = md_text[prev_end:m.start()]
+        parts.append(seg)
+        seg_starts.append(clean_len)
+        seg_pages.append(prev_page)
+        clean_len += len(seg)
+        prev_page = int(m.group(1))
+        prev_end = m.end()
+    tail = md_text[prev_end:]
+    parts.append(tail)
+    seg_starts.append(clean_len)
+    seg_pages.append(prev_page)
+
+    clean_text = "".join(parts)
+    if not clean_text.strip():
+        return []
+
+    # 2. 整篇只调一次切分器（而非每页一次）：200 页的 PDF 从 200 次
+    #    切分调用降为 1 次，页边界不再强制截断切片
+    rust = _get_rust_splitter()
+    if rust is not None:
+        chunks = rust.chunks(clean_text)
+    else:
+        chunks = _SPLITTER.split_text(clean_text)
+
+    # 3. 按切片起始偏移映射回页号（切片跨页时取起始页）。
+    #    先收集全部起始偏移，再用一次向量化 searchsorted 批量二分，
+    #    整个映射在 numpy 原生循环里完成，不走逐切片的 Python 调用
+    chunk_starts = np.empty(len(chunks), dtype=np.int64)
+    search_from = 0
+    for i, chunk in enumerate(chunks):
+        start = clean_text.find(chunk, search_from)
+        if start == -1:
+            start = search_from
+        chunk_starts[i] = start
+        search_from = start + 1
+    pages_ix = np.searchsorted(
+        np.asarray(seg_starts, dtype=np.int64), chunk_starts, side="right") - 1
+
     documents = []
-    
-    # 初始页码（第一个分隔符之前的内容）
-    current_page = 1 
-    
-    # page_splits 结果结构: [text_before, marker_full, page_num, text_after, marker_full, page_num, ...]
-    # 这种结构建议我们要小心遍历。
-    
-    # 如果文件以没有任何分隔符的文本开始，该文本属于第 1 页（默认）。
-    
-    # 让我们处理这个列表。
-    # 待切分的文本缓冲区
-    current_text_buffer = ""
-    
-    # 第一个元素总是文本（可能为空）
-    if len(page_splits) > 0:
-        current_text_buffer = page_splits[0]
-    
-    # 辅助函数：处理并切分缓冲区文本
-    def process_buffer(text, page):
-        if not text.strip():
-            return
-        
-        from langchain_text_splitters import RecursiveCharacterTextSplitter
-        
-        # 使用递归字符切分器作为主切分器，或者作为 Header 切分后的补充。
-        # 这里为了稳健性，直接使用递归切分，确保所有文本（包括引用块）都能被捕获。
-        # 尤其是当 PDF 解析的 Header 结构不完美时，HeaderSplitter 可能会漏掉内容或分块过大。
-        
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=500,
-            chunk_overlap=50,
-            separators=["\n\n", "\n", " ", ""]
-        )
-        docs = text_splitter.create_documents([text])
-        
-        for d in docs:
-            # 注入元数据
-            d.metadata["file_id"] = file_id
-            d.metadata["source"] = source
-            d.metadata["page"] = int(page)
-            # 清理内容
-            d.page_content = d.page_content.strip()
-            if d.page_content:
-                 documents.append(d)
-
-    # 处理第一个块（逻辑：如果第一个块为空，意味着文件以分隔符开始？）
-    # 如果没有找到分隔符，长度为 1。
-    if len(page_splits) == 1:
-        process_buffer(current_text_buffer, 1)
-        return documents
-
-    # 遍历三元组 (marker, page_num, text)
-    # i 的范围: 从 1 开始, 步长为 3
-    
-    # 首先处理初始缓冲区
-    process_buffer(current_text_buffer, 1)
-
-    for i in range(1, len(page_splits), 3):
-        # marker = page_splits[i]   # <!-- PAGE_BREAK: 2 -->
-        page_num_str = page_splits[i+1] # 2
-        content = page_splits[i+2]      # Text...
-        
-        current_page = int(page_num_str)
-        process_buffer(content, current_page)
-        
+    # 每页只构造一次引用模板/上下文头：这些字符串在查询热路径里
+    # （rag_service 的逐命中循环）原样复用，检索时不再逐 hit 拼 f-string
+    tmpl_by_page: Dict[int, tuple] = {}
+    for chunk, pi in zip(chunks, pages_ix):
+        content = chunk.strip()
+        if content:
+            page = int(seg_pages[int(pi)])
+            cached = tmpl_by_page.get(page)
+            if cached is None:
+                cached = (
+                    {
+                        "fileId": file_id,
+                        "sourceName": source,
+                        "page": page,
+                        "previewUrl": f"/api/v1/pdf/page?fileId={file_id}&page={page}&type=original",
+                    },
+                    f"Document: {source} (Page {page})\nContent: ",
+                )
+                tmpl_by_page[page] = cached
+            documents.append(Document(
+                page_content=content,
+                metadata={"file_id": file_id, "source": source, "page": page,
+                          "_citation_tmpl": cached[0], "_ctx_header": cached[1]},
+            ))
     return documents
 
+# ---------------------------------------------------------------------------
+# 嵌入缓存（内容寻址）
+# ---------------------------------------------------------------------------
+# 并行编码的分片大小：单片足够大以摊薄线程调度，足够小以产生并行度
+_EMBED_SHARD = 1024
+
+def _embed_documents_sharded(embeddings, texts: List[str]) -> np.ndarray:
+    """
+    大批量文本分片后线程池并行编码：PyTorch/ONNX 前向释放 GIL，
+    CPU 上可接近线性吃满多核，GPU 上可重叠 H2D 拷贝与计算。
+    小批量直接单线程，避免无谓的池开销。
+    """
+    if len(texts) <= _EMBED_SHARD:
+        return np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    shards = [texts[i:i + _EMBED_SHARD] for i in range(0, len(texts), _EMBED_SHARD)]
+    workers = min(len(shards), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        outs = list(ex.map(
+            lambda s: np.asarray(embeddings.embed_documents(s), dtype=np.float32), shards))
+    return np.concatenate(outs)
+
+def _embed_model_tag() -> bytes:
+    """嵌入模型身份标签：模型名 + 后端 + ONNX 产物文件，混入缓存键。"""
+    return "|".join((
+        os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-small-zh-v1.5"),
+        os.getenv("EMBEDDING_BACKEND", "hf").lower(),
+        os.getenv("ONNX_MODEL_FILE", ""),
+    )).encode("utf-8")
+
+def _cached_embed_documents(embeddings, texts: List[str]) -> np.ndarray:
+    """
+    SHA-256 内容寻址的嵌入缓存（sqlite）：重建索引或重复导入时，
+    内容未变的切片直接从磁盘取向量，只对未命中的文本跑 BGE 前向。
+    向量以 float32 tobytes 紧凑存储。
+    键混入模型标签（与 VLM 描述缓存同样的做法）：换嵌入模型/后端后
+    旧向量自然失效，不会把不同模型、不同维度的向量混进同一个索引。
+    """
+    con = sqlite3.connect(DATA_ROOT / "embed_cache.sqlite")
+    try:
+        con.execute("CREATE TABLE IF NOT EXISTS embed_cache (hash BLOB PRIMARY KEY, vec BLOB)")
+        tag = _embed_model_tag()
+        keys = [hashlib.sha256(tag + t.encode("utf-8")).digest() for t in texts]
+        vecs: List[Optional[np.ndarray]] = [None] * len(texts)
+        for i, key in enumerate(keys):
+            row = con.execute("SELECT vec FROM embed_cache WHERE hash=?", (key,)).fetchone()
+            if row:
+                vecs[i] = np.frombuffer(row[0], dtype=np.float32)
+        misses = [i for i, v in enumerate(vecs) if v is None]
+        if misses:
+            fresh = _embed_documents_sharded(embeddings, [texts[i] for i in misses])
+            for j, i in enumerate(misses):
+                vecs[i] = fresh[j]
+            con.executemany(
+                "INSERT OR REPLACE INTO embed_cache VALUES (?,?)",
+                [(keys[i], fresh[j].tobytes()) for j, i in enumerate(misses)])
+            con.commit()
+        if misses:
+            print(f"[*] 嵌入缓存: {len(texts) - len(misses)}/{len(texts)} 命中")
+        return np.stack(vecs)
+    finally:
+        con.close()
+
+# ---------------------------------------------------------------------------
+# FAISS 索引结构选择
+# ---------------------------------------------------------------------------
+def _make_raw_index(dim: int, n_vectors: int) -> "faiss.Index":
+    """
+    根据语料规模选择底层 FAISS 索引结构。
+    - 小语料（< FLAT_FALLBACK_NTOTAL）：精确的 IndexFlatIP，无需训练。
+    - 大语料：OPQ 预旋转 + IVF 倒排 + PQ 压缩（8bit 码本），
+      查询代价从 O(N·d) 降为 O(nprobe/nlist · N)，内存约缩小 32 倍。
+    BGE 向量已归一化，内积即余弦相似度。
+    """
+    if FAISS_FACTORY:
+        return faiss.index_factory(dim, FAISS_FACTORY, faiss.METRIC_INNER_PRODUCT)
+
+    if n_vectors < FLAT_FALLBACK_NTOTAL:
+        if FAISS_INDEX_KIND == "sq8":
+            # 无倒排的纯 SQ8：仍是精确全量扫描，但向量压成 int8，
+            # 内存/磁盘缩小 4 倍，内存带宽受限的场景扫描反而更快
+            return faiss.index_factory(dim, "SQ8", faiss.METRIC_INNER_PRODUCT)
+        return faiss.IndexFlatIP(dim)
+
+    # 经验值 nlist ≈ 4*sqrt(N)，同时保证训练样本 ≥ 256 条/聚类
+    nlist = max(64, min(4 * int(math.sqrt(n_vectors)), n_vectors // 256))
+
+    if FAISS_INDEX_KIND == "sq8":
+        # int8 标量量化：内存/带宽缩小 4 倍，FAISS 内部走 AVX2 int8 点积内核；
+        # 相比 PQ 压缩率低但几乎无精度损失
+        quantizer = faiss.IndexFlatIP(dim)
+        return faiss.IndexIVFScalarQuantizer(
+            quantizer, dim, nlist,
+            faiss.ScalarQuantizer.QT_8bit,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+
+    # M 必须整除维度且为偶数（bge-small-zh-v1.5 为 512 维 → M=32）
+    M = 32 if dim % 32 == 0 else 16
+    # PQ{M}x4fs：4bit 码本 + 交错内存布局，触发 FastScan SIMD 扫描内核
+    # （寄存器内查表，比标准 8bit PQ 扫描快 4~8 倍）
+    return faiss.index_factory(dim, f"OPQ{M},IVF{nlist},PQ{M}x4fs", faiss.METRIC_INNER_PRODUCT)
+
+def _training_sample(vectors: np.ndarray) -> np.ndarray:
+    """
+    限制训练集规模：k-means/码本收敛约需 256 条样本/聚类中心，
+    再多只会线性拖慢 train() 而不提升质量。超出时均匀抽样。
+    """
+    nlist = max(64, 4 * int(math.sqrt(len(vectors))))
+    max_train = 256 * nlist
+    if len(vectors) <= max_train:
+        return vectors
+    picked = np.random.default_rng(0).choice(len(vectors), max_train, replace=False)
+    return vectors[picked]
+
+def _set_nprobe(index, nprobe: int) -> None:
+    """在 IVF 类索引上设置 nprobe；Flat 索引上静默跳过。"""
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass
+
+@functools.lru_cache(maxsize=4096)
+def _embed_query_cached(text: str) -> tuple:
+    """查询向量 LRU：重复查询（前端重试/联想输入很常见）免去一次 BGE 前向。"""
+    return tuple(load_embeddings().embed_query(text))
+
+def _query_vec(text: str) -> np.ndarray:
+    # lru_cache 存不可变 tuple，避免缓存值被调用方原地改动
+    v = np.asarray(_embed_query_cached(text), dtype=np.float32)
+    # 与建库侧同样归一化，内积检索语义保持一致
+    v /= (np.linalg.norm(v) + 1e-12)
+    return v
+
+# file_id → 向量 ID 列表缓存（以 ntotal 为版本号，索引增量后自动失效）
+_FILE_IDS_CACHE: Dict[Any, np.ndarray] = {}
+
+def _file_ids_path() -> Path:
+    return GLOBAL_INDEX_DIR / "file_ids.pkl"
+
+def _load_file_table() -> Optional[Dict[str, Any]]:
+    """
+    读取 SoA 布局的文件归属表：
+    files   —— file_id 驻留表（去重后的字符串列表）
+    file_ix —— int32 数组，file_ix[i] = 向量 i 的 file_id 在 files 中的下标
+    相比每切片一个 metadata dict（AoS），整表只占 4 字节/向量，
+    过滤掩码可以用一次向量化比较得到。
+    """
+    try:
+        with open(_file_ids_path(), "rb") as f:
+            tbl = pickle.load(f)
+    except Exception:
+        return None
+    return tbl if isinstance(tbl, dict) and "file_ix" in tbl else None
+
+def _scan_file_table(vs: FAISS, upto: Optional[int] = None) -> tuple:
+    """从 docstore 元数据重建 SoA 表（无 sidecar 的旧索引升级路径）。"""
+    n = vs.index.ntotal if upto is None else upto
+    files: List[str] = []
+    interned: Dict[Any, int] = {}
+    out = np.empty(n, dtype=np.int32)
+    for i in range(n):
+        fid = vs.docstore.search(vs.index_to_docstore_id[i]).metadata.get("file_id")
+        if fid not in interned:
+            interned[fid] = len(files)
+            files.append(fid)
+        out[i] = interned[fid]
+    return files, out
+
+def _file_id_vector_ids(vs: FAISS, file_id: str) -> Optional[np.ndarray]:
+    """收集属于某 file_id 的全部 FAISS 向量 ID（LangChain 分配的顺序 ID）。"""
+    key = (file_id, vs.index.ntotal)
+    ids = _FILE_IDS_CACHE.get(key)
+    if ids is None:
+        tbl = _load_file_table()
+        if tbl is not None and len(tbl["file_ix"]) == vs.index.ntotal:
+            # 向量化比较直接得到该文件的全部向量 ID
+            if file_id in tbl["files"]:
+                fx = tbl["files"].index(file_id)
+                ids = np.nonzero(tbl["file_ix"] == fx)[0].astype(np.int64)
+            else:
+                ids = np.zeros(0, dtype=np.int64)
+        else:
+            # sidecar 缺失或与索引不同步：退回线性扫描 docstore 元数据
+            ids = np.fromiter(
+                (i for i, ds_id in vs.index_to_docstore_id.items()
+                 if vs.docstore.search(ds_id).metadata.get("file_id") == file_id),
+                dtype="int64",
+            )
+        _FILE_IDS_CACHE[key] = ids
+    return ids if len(ids) else None
+
+def _search_with_selector(vs: FAISS, query: str, k: int,
+                          ids: np.ndarray, nprobe: int) -> List[tuple]:
+    """
+    带 IDSelector 的原生 FAISS 搜索：过滤在 IVF/Flat 扫描阶段完成，
+    而不是 LangChain 的“先取 top-k 再 Python 后过滤”（会丢召回）。
+    """
+    xq = _query_vec(query)[None, :]
+    sel = faiss.IDSelectorBatch(ids)
+    try:
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe)
+        D, I = vs.index.search(xq, k, params=params)
+    except RuntimeError:
+        # 非 IVF 索引（Flat 等）：使用通用 SearchParameters
+        params = faiss.SearchParameters(sel=sel)
+        D, I = vs.index.search(xq, k, params=params)
+
+    hits = []
+    for idx, score in zip(I[0], D[0]):
+        if idx == -1:
+            continue
+        doc = vs.docstore.search(vs.index_to_docstore_id[int(idx)])
+        hits.append((doc, float(score)))
+    return hits
+
+# 只读向量库缓存：以 index.faiss 的 (路径, mtime) 为键，
+# 索引重建/追加保存后 mtime 变化，缓存自动失效重载
+_VS_CACHE: Dict[str, Any] = {"key": None, "vs": None}
+
+def load_global_vs_readonly(embeddings) -> FAISS:
+    """
+    只读加载全局索引，底层 faiss 索引走 mmap
+    （IO_FLAG_MMAP | IO_FLAG_READ_ONLY）：倒排表按需分页进内存，
+    RSS 只随实际访问的工作集增长，冷启动不再整体读盘，
+    多进程部署时页缓存还能跨 worker 共享。
+    进程内以 mtime 为版本做缓存，同一索引不会每次查询都重新反序列化。
+    注意：mmap 索引不可写，构建/追加路径仍用 get_global_index。
+    """
+    index_path = GLOBAL_INDEX_DIR / "index.faiss"
+    try:
+        key = (str(index_path), index_path.stat().st_mtime_ns)
+    except OSError:
+        key = None
+    if key is not None and _VS_CACHE["key"] == key:
+        return _VS_CACHE["vs"]
+
+    try:
+        index = faiss.read_index(
+            str(index_path),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+        # docstore 与 ID 映射沿用 LangChain 的 pickle 格式
+        with open(GLOBAL_INDEX_DIR / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        vs = FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+    except Exception as e:
+        print(f"⚠️ mmap 加载失败，回退 load_local: {e}")
+        vs = FAISS.load_local(str(GLOBAL_INDEX_DIR), embeddings,
+                              allow_dangerous_deserialization=True)
+
+    _VS_CACHE["key"], _VS_CACHE["vs"] = key, vs
+    return vs
+
+# 可写全局索引的进程内缓存：批量导入（ingest_all）逐文件 build 时
+# 不再每个文件整库重读反序列化；以 index.faiss 的 mtime 校验，
+# 外部进程改动过索引就重新加载
+_RW_CACHE: Dict[str, Any] = {"key": None, "vs": None}
+
+def _rw_cache_key() -> Optional[tuple]:
+    index_path = GLOBAL_INDEX_DIR / "index.faiss"
+    try:
+        return (str(index_path), index_path.stat().st_mtime_ns)
+    except OSError:
+        return None
+
+def _save_global_index(vs: FAISS) -> None:
+    """
+    替代 LangChain 的 save_local：faiss 索引照常写盘，docstore 与
+    ID 映射改用 pickle protocol 5（64 位帧 + 大对象单遍写出，
+    大 docstore 序列化快 2~3 倍）。文件布局保持 index.faiss + index.pkl，
+    与 load_local / load_global_vs_readonly 完全兼容。
+    保存后把内存中的索引登记为当前版本，后续追加免重读。
+    """
+    GLOBAL_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    faiss.write_index(vs.index, str(GLOBAL_INDEX_DIR / "index.faiss"))
+    with open(GLOBAL_INDEX_DIR / "index.pkl", "wb") as f:
+        pickle.dump((vs.docstore, vs.index_to_docstore_id), f, protocol=5)
+    _RW_CACHE["key"], _RW_CACHE["vs"] = _rw_cache_key(), vs
+
 # ---------------------------------------------------------------------------
 # 全局索引管理
 # ---------------------------------------------------------------------------
 def get_global_index(embeddings) -> FAISS:
     """加载全局索引或创建新索引"""
     if GLOBAL_INDEX_DIR.exists() and (GLOBAL_INDEX_DIR / "index.faiss").exists():
+        key = _rw_cache_key()
+        if key is not None and _RW_CACHE["key"] == key:
+            return _RW_CACHE["vs"]
         # print(f"[*] 正在从 {GLOBAL_INDEX_DIR} 加载全局索引")
-        return FAISS.load_local(str(GLOBAL_INDEX_DIR), embeddings, allow_dangerous_deserialization=True)
+        vs = FAISS.load_local(str(GLOBAL_INDEX_DIR), embeddings, allow_dangerous_deserialization=True)
+        _RW_CACHE["key"], _RW_CACHE["vs"] = key, vs
+        return vs
     else:
         print(f"[*] 正在 {GLOBAL_INDEX_DIR} 创建新的全局索引")
         # 初始化时需要至少一段文本。
@@ -190,7 +610,13 @@ def build_faiss_index(file_id: str) -> Dict[str, Any]:
         return {"ok": False, "error": f"未找到_MARKDOWN_文件: {md_file}"}
     
     try:
-        md_text = md_file.read_text(encoding="utf-8")
+        # mmap 读取：内核直接把页缓存映射进来，省掉 read() 的
+        # 内核→用户态双缓冲拷贝，大 Markdown 上峰值内存也更低
+        with open(md_file, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                md_text = mm[:].decode("utf-8")
+    except ValueError:
+        md_text = ""  # 空文件无法 mmap
     except Exception as e:
         return {"ok": False, "error": f"读取错误: {e}"}
 
@@ -207,56 +633,165 @@ def build_faiss_index(file_id: str) -> Dict[str, Any]:
     embeddings = load_embeddings()
     global_index = get_global_index(embeddings)
     
-    if global_index is None:
-        # 创建新的
-        global_index = FAISS.from_documents(docs, embedding=embeddings)
-    else:
-        #要在现有的基础上追加
-        global_index.add_documents(docs)
-    
+    # 新建与追加统一：所有切片一次性批量编码（分词 + GEMM 开销被摊薄），
+    # 再以预计算向量写入，避免 LangChain add_documents 逐条重编码
+    texts = [d.page_content for d in docs]
+    metadatas = [d.metadata for d in docs]
+    vectors = _cached_embed_documents(embeddings, texts)
+    # 批量 L2 归一化（numpy 向量化，对已归一化的 BGE 输出幂等）：
+    # 保证内积 == 余弦，同时兜底不做归一化的降级后端（OpenAI/Fake）
+    vectors /= (np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12)
+
+    fresh_index = global_index is None
+    if fresh_index:
+        # 创建新的：手动构建底层索引（而非 FAISS.from_documents 的默认 Flat L2），
+        # 以便在大语料上启用 OPQ+IVF+PQ
+        raw_index = _make_raw_index(vectors.shape[1], len(vectors))
+        if not raw_index.is_trained:
+            raw_index.train(_training_sample(vectors))
+
+        global_index = FAISS(
+            embedding_function=embeddings,
+            index=raw_index,
+            docstore=InMemoryDocstore(),
+            index_to_docstore_id={},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+    start_id = global_index.index.ntotal
+    global_index.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+
     # 保存
-    GLOBAL_INDEX_DIR.mkdir(parents=True, exist_ok=True)
-    global_index.save_local(str(GLOBAL_INDEX_DIR))
+    _save_global_index(global_index)
+
+    # 同步维护 SoA 文件归属表：搜索过滤时一次向量化比较即可
+    # 构建 IDSelector，不再扫描 docstore
+    if fresh_index:
+        files, file_ix = [], np.zeros(0, dtype=np.int32)
+    else:
+        tbl = _load_file_table()
+        if tbl is not None and len(tbl["file_ix"]) == start_id:
+            files, file_ix = tbl["files"], tbl["file_ix"]
+        else:
+            files, file_ix = _scan_file_table(global_index, upto=start_id)
+    if file_id in files:
+        fx = files.index(file_id)
+    else:
+        fx = len(files)
+        files.append(file_id)
+    n_new = global_index.index.ntotal - start_id
+    file_ix = np.concatenate([file_ix, np.full(n_new, fx, dtype=np.int32)])
+    with open(_file_ids_path(), "wb") as f:
+        pickle.dump({"files": files, "file_ix": file_ix}, f, protocol=5)
     print(f"[*] 全局索引已保存至 {GLOBAL_INDEX_DIR}")
     
     return {"ok": True, "chunks": len(docs), "index_path": str(GLOBAL_INDEX_DIR)}
 
-def search_faiss(query: str, filters: Dict[str, Any] = None, k: int = 5) -> Dict[str, Any]:
+def _public_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """剔除下划线前缀的内部字段（_citation_tmpl/_ctx_header 等
+    入库时预构的模板），不随 /index/search 响应外发。"""
+    return {k: v for k, v in meta.items() if not k.startswith("_")}
+
+def search_faiss(query: str, filters: Dict[str, Any] = None, k: int = 5, nprobe: Optional[int] = None) -> Dict[str, Any]:
     """
     搜索全局索引。
     'filters' 参数可用于元数据过滤 (例如 {'file_id': '...'})。
+    'nprobe' 控制 IVF 索引扫描的聚类数量（召回/延迟权衡）。
     """
     if not (GLOBAL_INDEX_DIR / "index.faiss").exists():
         return {"ok": False, "error": "全局索引未找到 (GLOBAL_INDEX_NOT_FOUND)"}
 
     embeddings = load_embeddings()
     try:
-        vs = FAISS.load_local(str(GLOBAL_INDEX_DIR), embeddings, allow_dangerous_deserialization=True)
-        
+        vs = load_global_vs_readonly(embeddings)
+        _set_nprobe(vs.index, nprobe or FAISS_NPROBE)
+
         # 如果提供了过滤器则应用
-        # LangChain FAISS 支持 filter 参数？是的，通常支持。
-        # 这取决于底层存储。如果使用 metadata，FAISS 是支持的。
-        kwargs = {}
-        if filters:
-            # kwargs['filter'] = filters 
-            # 注意：LangChain 基础版的 FAISS 实现可能需要特定设置才完全支持复杂过滤器，
-            # 但通常基础的字典匹配是有效的。
-            kwargs['filter'] = filters
-
-        search_kwargs = {"k": k, **kwargs}
-        hits = vs.similarity_search_with_score(query, **search_kwargs)
-        
+        # file_id 过滤优先走原生 IDSelector（在扫描阶段裁剪，保住真 top-k）；
+        # 其他元数据过滤仍走 LangChain 的字典匹配后过滤
+        hits = None
+        if filters and set(filters) == {"file_id"}:
+            ids = _file_id_vector_ids(vs, filters["file_id"])
+            if ids is None:
+                return {"ok": True, "results": []}
+            hits = _search_with_selector(vs, query, k, ids, nprobe or FAISS_NPROBE)
+
+        if hits is None:
+            kwargs = {}
+            if filters:
+                kwargs['filter'] = filters
+            # by_vector 变体让缓存的查询向量得以复用
+            hits = vs.similarity_search_with_score_by_vector(
+                _query_vec(query).tolist(), k=k, **kwargs)
+
         results = []
         for doc, score in hits:
             results.append({
                 "text": doc.page_content,
                 "score": float(score),
-                "metadata": doc.metadata, # 现在包含页码 (page) 和来源 (source)
+                "metadata": _public_metadata(doc.metadata), # 页码 (page) 和来源 (source)
             })
         return {"ok": True, "results": results}
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
+def search_faiss_batch(queries: List[str], filters: Dict[str, Any] = None, k: int = 5,
+                       nprobe: Optional[int] = None) -> Dict[str, Any]:
+    """
+    批量搜索全局索引：K 条查询一次性嵌入、一次 FAISS search
+    （单次 BLAS 调用），Python/调度开销按查询数摊薄。
+    适合多跳检索、重排候选生成等一次出多条查询的场景。
+    返回 results 为每条查询一个列表，顺序与 queries 对应。
+    仅 file_id 过滤会下推到 FAISS；其他过滤器退回逐条 search_faiss。
+    """
+    if not (GLOBAL_INDEX_DIR / "index.faiss").exists():
+        return {"ok": False, "error": "全局索引未找到 (GLOBAL_INDEX_NOT_FOUND)"}
+    if not queries:
+        return {"ok": True, "results": []}
+    if filters and set(filters) != {"file_id"}:
+        per_query = [search_faiss(q, filters=filters, k=k, nprobe=nprobe) for q in queries]
+        bad = next((r for r in per_query if not r["ok"]), None)
+        if bad:
+            return bad
+        return {"ok": True, "results": [r["results"] for r in per_query]}
+
+    embeddings = load_embeddings()
+    try:
+        vs = load_global_vs_readonly(embeddings)
+        _set_nprobe(vs.index, nprobe or FAISS_NPROBE)
+
+        X = np.asarray(embeddings.embed_documents(list(queries)), dtype=np.float32)
+        X /= (np.linalg.norm(X, axis=1, keepdims=True) + 1e-12)
+
+        if filters:
+            ids = _file_id_vector_ids(vs, filters["file_id"])
+            if ids is None:
+                return {"ok": True, "results": [[] for _ in queries]}
+            sel = faiss.IDSelectorBatch(ids)
+            try:
+                params = faiss.SearchParametersIVF(sel=sel, nprobe=nprobe or FAISS_NPROBE)
+                D, I = vs.index.search(X, k, params=params)
+            except RuntimeError:
+                D, I = vs.index.search(X, k, params=faiss.SearchParameters(sel=sel))
+        else:
+            D, I = vs.index.search(X, k)
+
+        results = []
+        for row_ids, row_scores in zip(I, D):
+            hits = []
+            for idx, score in zip(row_ids, row_scores):
+                if idx == -1:
+                    continue
+                doc = vs.docstore.search(vs.index_to_docstore_id[int(idx)])
+                hits.append({
+                    "text": doc.page_content,
+                    "score": float(score),
+                    "metadata": _public_metadata(doc.metadata),
+                })
+            results.append(hits)
+        return {"ok": True, "results": results}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
 # ---------------------------------------------------------------------------
 # 命令行接口 (CLI)
 # ---------------------------------------------------------------------------
@@ -0,0 +1,40 @@
+# services/jsonio.py
+"""
+JSON 读写的薄封装：优先使用 orjson（C/Rust 实现，3~10 倍于 stdlib，
+直接产出 bytes），未安装时回退到标准库 json。
+注册表 / meta.json / SSE 引用序列化等热路径统一走这里。
+"""
+from __future__ import annotations
+from typing import Any
+import json as _json
+
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
+
+
+def loads(data) -> Any:
+    """bytes 或 str → Python 对象"""
+    if _orjson is not None:
+        return _orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return _json.loads(data)
+
+
+def dumps_bytes(obj: Any, indent: bool = False) -> bytes:
+    """Python 对象 → UTF-8 bytes（适合直接 write_bytes）"""
+    if _orjson is not None:
+        opts = _orjson.OPT_NON_STR_KEYS
+        if indent:
+            opts |= _orjson.OPT_INDENT_2
+        return _orjson.dumps(obj, option=opts)
+    return _json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def dumps_str(obj: Any) -> str:
+    """Python 对象 → str（SSE data 行等文本场景）"""
+    if _orjson is not None:
+        return _orjson.dumps(obj).decode("utf-8")
+    return _json.dumps(obj, ensure_ascii=False)
@@ -7,22 +7,24 @@ import json
 import argparse
 import glob
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict, Any, List, Optional
 import fitz  # PyMuPDF
-from PIL import Image
-from langchain_unstructured import UnstructuredLoader
-from unstructured.partition.pdf import partition_pdf
-from html2text import html2text
+from PIL import Image, ImageDraw
 from dotenv import load_dotenv
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.patches as patches
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_agg import FigureCanvasAgg
+try:
+    from services import jsonio
+except ImportError:  # 直接以脚本方式运行本文件时
+    import jsonio
 import numpy as np
 import base64
+import functools
+import hashlib
+import multiprocessing
 import requests
+import subprocess
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # 加载环境变量 (如果需要)
 load_dotenv(override=True)
@@ -100,11 +102,13 @@ def find_pdf_file(file_id: str) -> Path:
     if original_path.exists():
         return original_path
         
-    # 2. 否则查找任意 PDF
-    pdf_files = list(workdir.glob("*.pdf"))
-    if pdf_files:
-        return pdf_files[0] # 返回第一个找到的 PDF
-        
+    # 2. 否则查找任意 PDF。scandir 命中即停：glob 会为目录里
+    # 所有条目（图片/产物越攒越多）建 Path 并收集成列表才返回第一个
+    with os.scandir(workdir) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(".pdf"):
+                return Path(entry.path)
+
     # 3. 默认返回标准路径（虽然不存在，但用于报错提示）
     return original_path
 
@@ -114,6 +118,14 @@ def get_markdown_output_path(file_id: str) -> Path:
 def get_segments_path(file_id: str) -> Path:
     return get_workdir(file_id) / "segments.json"
 
+def get_segments_by_page_path(file_id: str) -> Path:
+    """按页分组的 segments 索引（render_parsed_page 按页随机访问用）"""
+    return get_workdir(file_id) / "segments_by_page.json"
+
+def get_segments_npz_path(file_id: str) -> Path:
+    """segments 坐标的 SoA（列式 ndarray）缓存，渲染热路径免解析嵌套 dict"""
+    return get_workdir(file_id) / "segments.npz"
+
 def get_images_dir(file_id: str) -> Path:
     p = get_workdir(file_id) / "images"
     p.mkdir(parents=True, exist_ok=True)
@@ -125,44 +137,152 @@ def get_images_dir(file_id: str) -> Path:
 
 MODEL_NAME = os.getenv("VLM_MODEL_NAME", "deepseek-ai/deepseek-vl2")
 
+# VLM 并发度（纯网络 IO，瓶颈在服务端限流）
+VLM_CONCURRENCY = int(os.getenv("VLM_CONCURRENCY", "8"))
+
+# 模块级会话：连接池复用 TCP/TLS，多线程并发时免去每次握手。
+# max_retries=0 —— 重试逻辑在 get_vlm_caption 里自带指数退避，不能双重重试
+_VLM_SESSION = requests.Session()
+_VLM_SESSION.mount("https://", requests.adapters.HTTPAdapter(
+    pool_connections=16, pool_maxsize=32, max_retries=0))
+_VLM_SESSION.mount("http://", requests.adapters.HTTPAdapter(
+    pool_connections=16, pool_maxsize=32, max_retries=0))
+
 def encode_image_to_base64(image_path: str) -> Optional[str]:
-    """将图片文件转换为 Base64 编码"""
+    """
+    将图片文件转换为 Base64 编码。
+    非 JPEG 源先重压成 JPEG(q85)：截图类 PNG 通常缩小 3~5 倍，
+    直接降低上传带宽和 VLM 端的注入耗时（payload 声明的就是 image/jpeg）。
+    """
     if not os.path.exists(image_path):
         print(f"❌ [DEBUG] encode_image_to_base64: 找不到文件 {image_path} (PWD: {os.getcwd()})")
         return None
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    raw = None
+    if not image_path.lower().endswith((".jpg", ".jpeg")):
+        try:
+            buf = io.BytesIO()
+            with Image.open(image_path) as im:
+                im.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+            raw = buf.getvalue()
+        except Exception as e:
+            print(f"⚠️ JPEG 重压失败，按原始字节上传: {e}")
+    if raw is None:
+        with open(image_path, "rb") as image_file:
+            raw = image_file.read()
+    # base64 输出是纯 ASCII，ascii 解码比 utf-8 少一遍多字节校验
+    return base64.b64encode(raw).decode('ascii')
+
+# Caption 持久化缓存：键为图片字节 + 模型名的 BLAKE2b。
+# PDF 里重复的页眉/Logo 和跨运行的重复导入都直接命中，不再打 API
+_VLM_MEM_CACHE: Dict[str, str] = {}
+
+# 单次批量请求里最多带几张图（太多会顶 max_tokens，也更容易串序）
+VLM_BATCH_SIZE = max(1, int(os.getenv("VLM_BATCH_SIZE", "4")))
+
+# 针对运维场景优化的 Prompt (参考 notebook)
+_VLM_SYSTEM_PROMPT = "你是一个精通海洋工程与无人艇设备的运维专家。请简明扼要地解析图片。"
+_VLM_USER_PROMPT = "分析这张图片。如果是设备部件，请识别名称和状态（如腐蚀、断裂）；如果是图表，请提取关键数值；如果是电路图，请说明连接关系。请直接输出结论。"
+
+def _vlm_cache_store(cache_key: Optional[str], content: str) -> None:
+    """写入内存 + 磁盘缓存（临时文件原子替换，避免并发写出半截）"""
+    if not cache_key:
+        return
+    _VLM_MEM_CACHE[cache_key] = content
+    try:
+        cache_dir = DATA_ROOT / ".vlm_cache"
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = cache_dir / f"{cache_key}.tmp"
+        tmp.write_text(content, encoding="utf-8")
+        tmp.replace(cache_dir / f"{cache_key}.txt")
+    except OSError as e:
+        print(f"⚠️ VLM 缓存写入失败: {e}")
+
+def _vlm_cache_lookup(cache_key: Optional[str]) -> Optional[str]:
+    """内存缓存优先，其次磁盘缓存（命中后回填内存）"""
+    if not cache_key:
+        return None
+    cached = _VLM_MEM_CACHE.get(cache_key)
+    if cached is None:
+        cache_file = DATA_ROOT / ".vlm_cache" / f"{cache_key}.txt"
+        if cache_file.exists():
+            cached = cache_file.read_text(encoding="utf-8")
+            _VLM_MEM_CACHE[cache_key] = cached
+    return cached
+
+def _prepare_vlm_payload(image_path: str, skip_trivial: bool = True) -> tuple:
+    """
+    一次读盘 + 一次解码派生 VLM 调用需要的全部材料，
+    返回 (cache_key, cached_caption, b64)：
+    - cached_caption 非 None：缓存命中，免 API 调用；
+    - b64 为 None（且无缓存）：琐碎图（分隔线/图标/纯色块）或读取失败，跳过。
+    琐碎判定、缓存键、JPEG 重压共享同一份字节和同一个 Image 对象，
+    不再各自 open+decode 同一个文件 2~3 遍。
+    """
+    try:
+        raw = Path(image_path).read_bytes()
+    except OSError:
+        print(f"❌ [DEBUG] 读取图片失败: {image_path}")
+        return None, None, None
+
+    h = hashlib.blake2b(raw, digest_size=16)
+    h.update(MODEL_NAME.encode("utf-8"))  # 换模型自动失效
+    cache_key = h.hexdigest()
+    cached = _vlm_cache_lookup(cache_key)
+    if cached is not None:
+        return cache_key, cached, None
+
+    # JPEG 源免重压；其余格式转 JPEG(q85) 缩小上传体积
+    jpeg = raw if image_path.lower().endswith((".jpg", ".jpeg")) else None
+    try:
+        with Image.open(io.BytesIO(raw)) as im:
+            if skip_trivial:
+                # getcolors 超过 maxcolors 返回 None —— 颜色丰富，按真实图片处理
+                colors = im.getcolors(maxcolors=16)
+                if min(im.size) < 64 or (colors is not None and len(colors) <= 4):
+                    return cache_key, None, None
+            if jpeg is None:
+                buf = io.BytesIO()
+                im.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+                jpeg = buf.getvalue()
+    except Exception as e:
+        if jpeg is None:
+            print(f"⚠️ JPEG 重压失败，按原始字节上传: {e}")
+            jpeg = raw
+    return cache_key, None, base64.b64encode(jpeg).decode("ascii")
 
 def get_vlm_caption(image_path: str) -> str:
-    """调用 API 解析图片，获取 Caption"""
+    """调用 API 解析图片，获取 Caption（内容寻址缓存，命中免 API 调用）"""
+    cache_key, cached, b64_img = _prepare_vlm_payload(image_path, skip_trivial=False)
+    if cached is not None:
+        print(f"    [VLM] 缓存命中: {os.path.basename(image_path)}")
+        return cached
+    if not b64_img:
+        print(f"⚠️ [DEBUG] 图片转 Base64 失败: {image_path}")
+        return ""
+    return get_vlm_caption_from_b64(b64_img, os.path.basename(image_path), cache_key)
+
+def get_vlm_caption_from_b64(b64_img: str, display_name: str,
+                             cache_key: Optional[str] = None) -> str:
+    """已有 base64 payload 时的调用入口（批量流程预先编码后直接进来）"""
     # 优先读取 SILICONFLOW_API_KEY，其次 SILICON_API_KEY (兼容 .env)
     api_key = os.getenv("SILICONFLOW_API_KEY") or os.getenv("SILICON_API_KEY")
-    
+
     if not api_key:
         print("⚠️ [DEBUG] 未配置 API Key，跳过")
         return "> **AI视觉解析**：(未配置 API Key，无法解析)"
 
-    b64_img = encode_image_to_base64(image_path)
-    if not b64_img: 
-        print(f"⚠️ [DEBUG] 图片转 Base64 失败: {image_path}")
-        return ""
-
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
 
-    # 针对运维场景优化的 Prompt (参考 notebook)
-    system_prompt = "你是一个精通海洋工程与无人艇设备的运维专家。请简明扼要地解析图片。"
-    user_prompt = "分析这张图片。如果是设备部件，请识别名称和状态（如腐蚀、断裂）；如果是图表，请提取关键数值；如果是电路图，请说明连接关系。请直接输出结论。"
-
     payload = {
         "model": MODEL_NAME,
         "messages": [
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": _VLM_SYSTEM_PROMPT},
             {"role": "user", "content": [
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_img}"}},
-                {"type": "text", "text": user_prompt}
+                {"type": "text", "text": _VLM_USER_PROMPT}
             ]}
         ],
         "temperature": 0.1,
@@ -180,11 +300,11 @@ def get_vlm_caption(image_path: str) -> str:
             start_time = time.time()
             # 打印日志 (仅首次)
             if attempt == 0:
-                print(f"    [VLM] 正在分析图片: {os.path.basename(image_path)} ...")
+                print(f"    [VLM] 正在分析图片: {display_name} ...")
             else:
-                print(f"    ⚠️ [VLM] 重试 ({attempt}/{max_retries}): {os.path.basename(image_path)} ...")
+                print(f"    ⚠️ [VLM] 重试 ({attempt}/{max_retries}): {display_name} ...")
 
-            response = requests.post(api_url, headers=headers, json=payload, timeout=30)
+            response = _VLM_SESSION.post(api_url, headers=headers, json=payload, timeout=30)
             response.raise_for_status()
             
             result = response.json()
@@ -192,6 +312,8 @@ def get_vlm_caption(image_path: str) -> str:
             
             duration = time.time() - start_time
             print(f"    ✅ VLM 分析完成 (耗时 {duration:.2f}s, 尝试 {attempt+1}次): {content[:30]}...")
+
+            _vlm_cache_store(cache_key, content)
             return content
             
         except (requests.exceptions.RequestException, requests.exceptions.HTTPError, ConnectionError) as e:
@@ -210,38 +332,117 @@ def get_vlm_caption(image_path: str) -> str:
             print(f"    ❌ VLM 非期待错误: {e}")
             return f"(VLM 处理发生错误: {str(e)})"
 
+def get_vlm_captions_batch(tasks: List[tuple]) -> Dict[str, str]:
+    """
+    多图合并调用：一条 user 消息带 batch 内全部 image_url，要求模型按序
+    输出 JSON 数组。N 张图的网络往返和 prefill 从 N 次摊到 ceil(N/k) 次。
+    tasks 为 [(图片名, cache_key, b64), ...]；JSON 解析失败或有缺漏时，
+    缺的图退回逐张调用，不会丢 caption。
+    """
+    captions: Dict[str, str] = {}
+    if len(tasks) == 1:
+        name, key, b64 = tasks[0]
+        return {name: get_vlm_caption_from_b64(b64, name, key)}
+
+    api_key = os.getenv("SILICONFLOW_API_KEY") or os.getenv("SILICON_API_KEY")
+    if not api_key:
+        print("⚠️ [DEBUG] 未配置 API Key，跳过")
+        return {t[0]: "> **AI视觉解析**：(未配置 API Key，无法解析)" for t in tasks}
+
+    content = [{"type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{b64}"}}
+               for _, _, b64 in tasks]
+    content.append({"type": "text", "text": (
+        f"依次分析以上 {len(tasks)} 张图片。{_VLM_USER_PROMPT}\n"
+        "严格输出 JSON 数组，每张图一项："
+        '[{"idx": 1, "caption": "..."}, {"idx": 2, "caption": "..."}, ...]，'
+        "不要输出数组以外的任何内容。")})
+    payload = {
+        "model": MODEL_NAME,
+        "messages": [
+            {"role": "system", "content": _VLM_SYSTEM_PROMPT},
+            {"role": "user", "content": content},
+        ],
+        "temperature": 0.1,
+        # 批内每张图预留足额输出空间
+        "max_tokens": 512 * len(tasks),
+    }
+    headers = {"Authorization": f"Bearer {api_key}",
+               "Content-Type": "application/json"}
+    api_url = os.getenv("VLM_API_URL", "https://api.siliconflow.cn/v1/chat/completions")
+
+    try:
+        start_time = time.time()
+        print(f"    [VLM] 批量分析 {len(tasks)} 张图片 ...")
+        response = _VLM_SESSION.post(api_url, headers=headers, json=payload, timeout=60)
+        response.raise_for_status()
+        text = response.json()['choices'][0]['message']['content'].strip()
+        # 容忍模型裹一层 markdown 代码块
+        if text.startswith("```"):
+            text = text.strip("`").lstrip("json").strip()
+        arr = jsonio.loads(text)
+        by_idx = {d.get("idx"): d.get("caption") for d in arr if isinstance(d, dict)}
+        for i, (name, key, _) in enumerate(tasks, start=1):
+            cap = (by_idx.get(i) or "").strip()
+            if cap:
+                captions[name] = cap
+                _vlm_cache_store(key, cap)
+        print(f"    ✅ VLM 批量完成 (耗时 {time.time() - start_time:.2f}s, "
+              f"{len(captions)}/{len(tasks)} 张解析成功)")
+    except Exception as e:
+        print(f"    ⚠️ VLM 批量调用失败，退回逐张: {e}")
+
+    # 缺漏补齐：逐张路径自带重试/退避
+    for name, key, b64 in tasks:
+        if name not in captions:
+            captions[name] = get_vlm_caption_from_b64(b64, name, key)
+    return captions
+
 # ---------------------------------------------------------------------------
 # 4. 核心功能函数
 # ---------------------------------------------------------------------------
 
 def save_upload_file(file_id: str, upload_bytes: bytes, filename: str) -> Dict[str, Any]:
-    """保存上传的 PDF 文件"""
+    """保存上传的 PDF 文件（整段字节版，CLI/测试用）"""
     # 这里我们还是倾向于保存为 original.pdf 以保持标准化，
     # 但也可以修改为保存原文件名，只要后续 find_pdf_file 能找到即可。
-    # 为了兼容性，这里暂时保持保存为 original.pdf，
-    # 但你也完全可以改为: save_path = get_workdir(file_id) / filename
-    
-    work_dir = get_workdir(file_id)
-    pdf_path = work_dir / "original.pdf"
+    pdf_path = get_original_pdf_path(file_id)
     pdf_path.write_bytes(upload_bytes)
-    
-    with fitz.open(pdf_path) as doc:
+    # 字节已在内存里：直接 stream 打开数页数，免去刚写完又读盘重解析一遍
+    with fitz.open(stream=upload_bytes, filetype="pdf") as doc:
         pages = doc.page_count
-        
+    return register_upload_file(file_id, filename, page_count=pages)
+
+def register_upload_file(file_id: str, filename: str,
+                         page_count: Optional[int] = None) -> Dict[str, Any]:
+    """
+    PDF 已落盘（original.pdf）后登记元数据。
+    流式上传路径直接往目标路径写块，再调用本函数，避免整个文件进内存。
+    调用方已知页数时通过 page_count 传入，省一次 xref 解析。
+    """
+    work_dir = get_workdir(file_id)
+    pdf_path = work_dir / "original.pdf"
+
+    if page_count is not None:
+        pages = page_count
+    else:
+        with fitz.open(pdf_path) as doc:
+            pages = doc.page_count
+
     # 保存元数据 (新增)
     meta_path = work_dir / "meta.json"
     meta_data = {
         "id": file_id,
         "original_filename": filename,
         "upload_time": time.time(),
-        "size_bytes": len(upload_bytes),
+        "size_bytes": pdf_path.stat().st_size,
         "page_count": pages
     }
     try:
-        meta_path.write_text(json.dumps(meta_data, ensure_ascii=False, indent=2), encoding="utf-8")
+        meta_path.write_bytes(jsonio.dumps_bytes(meta_data, indent=True))
     except Exception as e:
         print(f"⚠️ Warning: Failed to save meta.json: {e}")
-        
+
     return {
         "file_id": file_id,
         "filename": filename,
@@ -262,6 +463,140 @@ def delete_file(file_id: str) -> bool:
             return False
     return False
 
+def _extract_page_images(pdf_path: str, page_num: int, img_dir: Path) -> tuple:
+    """
+    提取单页的全部内嵌图片，返回 (page_num, [(图片文件名, xref)])。
+    进程/线程池工作函数：自行打开 Document（fitz 句柄不可跨进程 pickle）。
+    """
+    entries = []
+    seen_on_page: Dict[int, str] = {}
+    with fitz.open(pdf_path) as doc:
+        page = doc[page_num - 1]
+        for img_index, img in enumerate(page.get_images(full=True), start=1):
+            xref, smask = img[0], img[1]
+
+            # 同页内重复引用同一 xref：免解码免落盘，直接复用
+            if xref in seen_on_page:
+                entries.append((seen_on_page[xref], xref))
+                continue
+
+            # 零转码路径：PDF 内嵌的 JPEG/JP2 等已压缩流直接原样落盘，
+            # 免去 解码→Pixmap→重编码 的整套 CPU 开销。
+            # 带 smask（透明蒙版）的图片仍需 Pixmap 合成，走回退路径
+            info = None if smask else doc.extract_image(xref)
+            if info and info.get("image"):
+                img_name = f"page{page_num}_img{img_index}.{info['ext']}"
+                (img_dir / img_name).write_bytes(info["image"])
+                seen_on_page[xref] = img_name
+                entries.append((img_name, xref))
+                continue
+
+            pix = fitz.Pixmap(doc, xref)
+            img_name = f"page{page_num}_img{img_index}.png"
+
+            if pix.n >= 5:
+                # CMYK/带额外通道：先转 RGB 再编码，只走一次转换
+                pix = fitz.Pixmap(fitz.csRGB, pix)
+            # tobytes + write_bytes 一次落盘，省掉 save() 内部的临时文件路径处理
+            (img_dir / img_name).write_bytes(pix.tobytes(output="png"))
+            pix = None
+
+            seen_on_page[xref] = img_name
+            entries.append((img_name, xref))
+    return page_num, entries
+
+# 批量 OCR 配置：一次 tesseract 进程跑完全部页面（filelist 模式），
+# 把模型加载/初始化成本（约 200ms/次）摊到整本 PDF 上
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+OCR_LANGS = os.getenv("OCR_LANGS", "chi_sim+eng")
+
+def _batched_ocr_elements(pdf_path: str, workdir: Path) -> Optional[list]:
+    """
+    ocr_only 策略的快速路径：PyMuPDF 统一渲染页面位图，写 filelist
+    后只起一次 tesseract 进程批量识别，避免逐页调用重复付初始化开销。
+    返回逐页的轻量元素列表；tesseract 不可用或失败时返回 None（走回退）。
+    """
+    if not shutil.which("tesseract"):
+        return None
+
+    ocr_dir = workdir / ".ocr_pages"
+    ocr_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        page_paths = []
+        with fitz.open(pdf_path) as doc:
+            for i, page in enumerate(doc, start=1):
+                p = ocr_dir / f"page{i}.png"
+                page.get_pixmap(dpi=OCR_DPI).save(str(p))
+                page_paths.append(str(p))
+
+        filelist = ocr_dir / "filelist.txt"
+        filelist.write_text("\n".join(page_paths), encoding="utf-8")
+        out_base = ocr_dir / "ocr_out"
+
+        print(f"[*] 批量 OCR：{len(page_paths)} 页，单次 tesseract 调用 ...")
+        subprocess.run(
+            ["tesseract", str(filelist), str(out_base), "-l", OCR_LANGS, "txt"],
+            check=True, capture_output=True,
+        )
+
+        # txt 模式默认以换页符 \f 分隔各页输出
+        pages_text = (out_base.with_suffix(".txt")
+                      .read_text(encoding="utf-8", errors="ignore").split("\f"))
+        elements = []
+        for i, text in enumerate(pages_text[:len(page_paths)], start=1):
+            text = text.strip()
+            if text:
+                elements.append(_CachedElement({
+                    "category": "NarrativeText",
+                    "text": text,
+                    "metadata": {"page_number": i},
+                }))
+        return elements
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"⚠️ 批量 OCR 失败，回退 partition_pdf: {e}")
+        return None
+    finally:
+        shutil.rmtree(ocr_dir, ignore_errors=True)
+
+def _build_segments_soa(segments: list) -> Optional[Dict[str, np.ndarray]]:
+    """
+    把带坐标的 segments 压成 Struct-of-Arrays：页码/版面尺寸/类别各一列，
+    全部多边形顶点拼成一个 (total_pts, 2) float32 数组，用前缀偏移切分。
+    渲染时按页过滤是一次布尔掩码，不再逐元素追三层嵌套 dict。
+    """
+    pages, layout_wh, cats, counts, pts = [], [], [], [], []
+    for s in segments:
+        md = s.get("metadata") or {}
+        coords = md.get("coordinates") or {}
+        p = coords.get("points")
+        w, h = coords.get("layout_width"), coords.get("layout_height")
+        if not p or not w or not h:
+            continue
+        pages.append(md.get("page_number") or 0)
+        layout_wh.append((w, h))
+        cats.append(s.get("category") or "Uncategorized")
+        counts.append(len(p))
+        pts.extend(p)
+    if not pages:
+        return None
+    return {
+        "page": np.asarray(pages, dtype=np.int32),
+        "layout_wh": np.asarray(layout_wh, dtype=np.float32),
+        "category": np.asarray(cats),
+        "pt_offset": np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+        "points": np.asarray(pts, dtype=np.float32),
+    }
+
+class _CachedElement:
+    """从 segments.json 复原的轻量元素：只带组装 Markdown 需要的三个属性。"""
+    __slots__ = ("category", "text", "metadata")
+
+    def __init__(self, d: Dict[str, Any]):
+        self.category = d.get("category") or d.get("type")
+        self.text = d.get("text", "")
+        md = d.get("metadata") or {}
+        self.metadata = SimpleNamespace(**md) if isinstance(md, dict) else md
+
 def convert_pdf_to_markdown(file_id: str, strategy: str = "hi_res") -> Dict[str, Any]:
     """完整流程：提取 PDF 内容并转换为 Markdown"""
     
@@ -279,87 +614,194 @@ def convert_pdf_to_markdown(file_id: str, strategy: str = "hi_res") -> Dict[str,
     if not pdf_path_obj.exists():
         raise FileNotFoundError(f"在目录 {pdf_path_obj.parent} 下未找到任何 PDF 文件")
 
+    # 0. 解析缓存：PDF 内容哈希和策略都没变时直接复用 segments.json，
+    # 跳过整个 partition_pdf（hi_res 的版面检测 + OCR 是全流程最贵的一步）。
+    # 哈希要读整个文件，顺手用同一份字节 stream 打开拿页数，
+    # 不再为 page_count 单独 fitz.open 重解析一次 xref 表
+    pdf_bytes = pdf_path_obj.read_bytes()
+    pdf_hash = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as _doc:
+        page_count = _doc.page_count
+    del pdf_bytes
+    meta_path = get_workdir(file_id) / "meta.json"
+    meta: Dict[str, Any] = {}
+    if meta_path.exists():
+        try:
+            meta = jsonio.loads(meta_path.read_bytes())
+        except Exception:
+            meta = {}
+
+    elements = None
+    if (meta.get("content_hash") == pdf_hash
+            and meta.get("last_strategy") == strategy
+            and get_segments_path(file_id).exists()):
+        try:
+            cached = jsonio.loads(get_segments_path(file_id).read_bytes())
+            elements = [_CachedElement(d) for d in cached]
+            print(f"[*] 解析缓存命中 ({len(elements)} segments)，跳过 partition_pdf")
+        except Exception as e:
+            print(f"⚠️ 解析缓存读取失败，重新解析: {e}")
+            elements = None
+
+    cache_hit = elements is not None
+
     # 1. 解析元素
-    partition_kwargs = {
-        "filename": pdf_path,
-        "strategy": strategy,
-        "infer_table_structure": (strategy == "hi_res"),
-    }
-    
-    # 根据需要启用 OCR
-    if strategy == "hi_res":
-        # partition_kwargs["ocr_languages"] = ["chi_sim", "eng"]
-        pass
+    # ocr_only 走批量 tesseract 快速路径（文字为主的扫描件跳过版面检测）
+    if elements is None and strategy == "ocr_only":
+        elements = _batched_ocr_elements(pdf_path, get_workdir(file_id))
 
-    elements = partition_pdf(**partition_kwargs)
+    if elements is None:
+        partition_kwargs = {
+            "filename": pdf_path,
+            "strategy": strategy,
+            "infer_table_structure": (strategy == "hi_res"),
+        }
 
-    # 保存解析结果（Segments）到 JSON，用于后续可视化
-    try:
-        segments = []
-        for el in elements:
-            if hasattr(el, "to_dict"):
-                segments.append(el.to_dict())
-            else:
-                # Fallback if to_dict not available
-                segments.append({
-                    "category": getattr(el, "category", "Uncategorized"),
-                    "text": str(el),
-                    "metadata": getattr(el, "metadata", {}).__dict__ if hasattr(getattr(el, "metadata", None), "__dict__") else {}
-                })
-        
-        segments_path = get_segments_path(file_id)
-        segments_path.write_text(json.dumps(segments, ensure_ascii=False, indent=2), encoding="utf-8")
-        print(f"[*] 解析 Segments 已保存: {segments_path}")
-    except Exception as e:
-        print(f"⚠️ 保存 Segments 失败: {e}")
+        # 根据需要启用 OCR
+        if strategy == "hi_res":
+            # partition_kwargs["ocr_languages"] = ["chi_sim", "eng"]
+            pass
+
+        # unstructured 连带 torch/版面模型是整个模块最重的导入（秒级）。
+        # 函数级懒加载：只上传/预览的 worker 进程不用陪着付这笔启动开销，
+        # 解析缓存/批量 OCR 命中时同样完全绕开
+        from unstructured.partition.pdf import partition_pdf
+
+        elements = partition_pdf(**partition_kwargs)
+
+    if not cache_hit:
+        # 保存解析结果（Segments）到 JSON，用于后续可视化
+        try:
+            segments = []
+            for el in elements:
+                if hasattr(el, "to_dict"):
+                    segments.append(el.to_dict())
+                else:
+                    # Fallback if to_dict not available
+                    segments.append({
+                        "category": getattr(el, "category", "Uncategorized"),
+                        "text": str(el),
+                        "metadata": getattr(el, "metadata", {}).__dict__ if hasattr(getattr(el, "metadata", None), "__dict__") else {}
+                    })
+
+            segments_path = get_segments_path(file_id)
+            # orjson（jsonio）写出：C 实现快 5~10 倍；不缩进——这个文件只给
+            # render_parsed_page 机读，缩进徒增一倍体积
+            segments_path.write_bytes(jsonio.dumps_bytes(segments))
+            print(f"[*] 解析 Segments 已保存: {segments_path}")
+
+            # 顺手建好按页分组的索引：逐页预览时 O(本页 segments) 取数，
+            # 不必每次请求都过滤全量列表
+            by_page: Dict[str, list] = {}
+            for s in segments:
+                p = (s.get("metadata") or {}).get("page_number", 0)
+                by_page.setdefault(str(p), []).append(s)
+            get_segments_by_page_path(file_id).write_bytes(jsonio.dumps_bytes(by_page))
+
+            # 坐标列式缓存：渲染端直接 np.load，掩码取页、一次广播缩放
+            soa = _build_segments_soa(segments)
+            if soa is not None:
+                np.savez(get_segments_npz_path(file_id), **soa)
+        except Exception as e:
+            print(f"⚠️ 保存 Segments 失败: {e}")
+
+        # 记录缓存键，供下次命中判断
+        meta["content_hash"] = pdf_hash
+        meta["last_strategy"] = strategy
+        try:
+            meta_path.write_bytes(jsonio.dumps_bytes(meta, indent=True))
+        except Exception as e:
+            print(f"⚠️ 更新 meta.json 失败: {e}")
 
     # 2. 提取图片并调用 VLM
+    # 页面相互独立：并行提取。顶层进程用进程池（Pixmap 解码是 CPU 密集，
+    # 彻底绕开 GIL）；已经身处 ingest_all 的子进程时退回线程池，
+    # 避免进程池嵌套（PyMuPDF 解码时也释放 GIL，线程仍有并行度）
     image_map = {}
     image_caption_map = {} # 存储图片描述
-    with fitz.open(pdf_path) as doc:
-        for page_num, page in enumerate(doc, start=1):
-            image_map[page_num] = []
-            for img_index, img in enumerate(page.get_images(full=True), start=1):
-                xref = img[0]
-                pix = fitz.Pixmap(doc, xref)
-                img_name = f"page{page_num}_img{img_index}.png"
-                img_path = img_dir / img_name
-                
-                if pix.n < 5:
-                    pix.save(str(img_path))
-                else:
-                    pix = fitz.Pixmap(fitz.csRGB, pix)
-                    pix.save(str(img_path))
-                
-                image_map[page_num].append(img_name)
-                
-                # ------ VLM 调用 ------
-                # 提取后立即调用 VLM 获取描述
-                caption = get_vlm_caption(str(img_path))
-                if caption:
-                    image_caption_map[img_name] = caption
-                # ---------------------
-    
+
+    in_child = multiprocessing.parent_process() is not None
+    pool_cls = ThreadPoolExecutor if in_child else ProcessPoolExecutor
+    workers = min(os.cpu_count() or 1, 8 if in_child else 4)
+    extract = functools.partial(_extract_page_images, pdf_path, img_dir=img_dir)
+    # 跨页去重：同一 xref（页眉 Logo、重复题图）只保留首次落盘的文件，
+    # 后续页复用同一文件名，冗余副本删除 —— VLM 也只为它付一次调用
+    seen_xrefs: Dict[int, str] = {}
+    dup_count = 0
+    with pool_cls(max_workers=workers) as ex:
+        for page_num, entries in ex.map(extract, range(1, page_count + 1)):
+            names = []
+            for name, xref in entries:
+                canon = seen_xrefs.setdefault(xref, name)
+                if canon != name:
+                    dup_count += 1
+                    try:
+                        (img_dir / name).unlink()
+                    except OSError:
+                        pass
+                names.append(canon)
+            image_map[page_num] = names
+
+    if dup_count:
+        print(f"[*] 跨页去重：{dup_count} 处重复内嵌图片复用同一文件")
     print(f"[*] 图片提取完成，保存在: {img_dir}")
 
+    # VLM 描述（网络 IO，与 CPU 提取阶段分离）：
+    # 线程池一次性扇出全部图片，N 张图的等待从 sum(延迟) 变 max(延迟)；
+    # 重试退避在各自线程内 sleep，互不阻塞
+    # dict.fromkeys 去重保序：跨页复用的图片只提交一次
+    all_imgs = list(dict.fromkeys(
+        name for names in image_map.values() for name in names))
+    # 每张图一次读盘一次解码，同时产出琐碎判定 / 缓存键 / JPEG payload；
+    # 缓存命中当场收下，线程池里只剩真正要打 API 的任务
+    vlm_tasks = []
+    skipped = 0
+    for name in all_imgs:
+        cache_key, cached, b64 = _prepare_vlm_payload(str(img_dir / name))
+        if cached is not None:
+            print(f"    [VLM] 缓存命中: {name}")
+            image_caption_map[name] = cached
+        elif b64 is None:
+            skipped += 1
+        else:
+            vlm_tasks.append((name, cache_key, b64))
+    if skipped:
+        print(f"[*] 跳过 {skipped} 张琐碎图片的 VLM 解析")
+    if vlm_tasks:
+        # 每 VLM_BATCH_SIZE 张并成一次 multi-image 请求，批之间仍并发
+        batches = [vlm_tasks[i:i + VLM_BATCH_SIZE]
+                   for i in range(0, len(vlm_tasks), VLM_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=VLM_CONCURRENCY) as ex:
+            for caps in ex.map(get_vlm_captions_batch, batches):
+                for name, caption in caps.items():
+                    if caption:
+                        image_caption_map[name] = caption
+
     # 3. 组装 Markdown
-    md_lines: List[str] = []
+    # 直接累积 UTF-8 字节：免去最后 join 出一个巨型 str 再在
+    # write_text 里整体编码的两次全量拷贝
+    md_buf = bytearray()
     inserted_images = set()
-    
+
+    def _emit(s: str):
+        if md_buf:
+            md_buf.extend(b"\n")  # 复刻 "\n".join 的分隔语义
+        md_buf.extend(s.encode("utf-8"))
+
     def insert_page_images(p_num):
         """Helper: 插入指定页面的所有未插入图片"""
         if p_num in image_map:
             for name in image_map[p_num]:
                 if (p_num, name) not in inserted_images:
-                    md_lines.append(f"\n![Image](./images/{name})\n")
+                    _emit(f"\n![Image](./images/{name})\n")
                     if name in image_caption_map:
                         caption_text = image_caption_map[name]
-                        md_lines.append(f"> **AI视觉解析**：{caption_text}\n")
+                        _emit(f"> **AI视觉解析**：{caption_text}\n")
                     inserted_images.add((p_num, name))
 
     # --- Helper to insert page break marker ---
     def insert_page_break(p_num):
-        md_lines.append(f"\n<!-- PAGE_BREAK: {p_num} -->\n")
+        _emit(f"\n<!-- PAGE_BREAK: {p_num} -->\n")
 
     last_page_seen = 0
     
@@ -386,20 +828,21 @@ def convert_pdf_to_markdown(file_id: str, strategy: str = "hi_res") -> Dict[str,
             continue
 
         if category == "Title":
-            md_lines.append(f"# {text}\n")
+            _emit(f"# {text}\n")
         elif category in ["Header", "Subheader"]:
-            md_lines.append(f"## {text}\n")
+            _emit(f"## {text}\n")
         elif category == "Table":
             html = getattr(metadata, "text_as_html", None) if metadata else None
             if html:
-                md_lines.append(html2text(html) + "\n")
+                from html2text import html2text  # 懒加载：仅表格页需要
+                _emit(html2text(html) + "\n")
             else:
-                md_lines.append(text + "\n")
+                _emit(text + "\n")
         elif category == "Image" and page_num:
             # 如果 unstructured 识别到了图片占位符，直接在此处插入
             insert_page_images(page_num)
         else:
-            md_lines.append(text + "\n")
+            _emit(text + "\n")
 
     # --- Final Flush: 处理最后一页或剩余页面的图片 ---
     max_p = max(image_map.keys()) if image_map else 0
@@ -409,13 +852,12 @@ def convert_pdf_to_markdown(file_id: str, strategy: str = "hi_res") -> Dict[str,
 
     # 写入文件
     print(f"[*] 正在写入 Markdown 文件: {out_md_path}")
-    markdown_content = "\n".join(md_lines)
-    out_md_path.write_text(markdown_content, encoding="utf-8")
-    
+    out_md_path.write_bytes(bytes(md_buf))
+
     return {
         "markdown_path": str(out_md_path),
         "images_dir": str(img_dir),
-        "content_preview": markdown_content[:500] if markdown_content else ""
+        "content_preview": bytes(md_buf[:500]).decode("utf-8", "ignore")
     }
 
 def render_parsed_page(file_id: str, page_number: int) -> Optional[bytes]:
@@ -423,18 +865,36 @@ def render_parsed_page(file_id: str, page_number: int) -> Optional[bytes]:
     渲染指定页面的解析结果（带边框），返回 PNG 图片字节流
     """
     try:
-        # 1. 加载 Segments
-        seg_path = get_segments_path(file_id)
-        if not seg_path.exists():
-            return None
-            
-        segments = json.loads(seg_path.read_text(encoding="utf-8"))
-        
-        # 筛选当前页的 segments (注意 unstructured 的 page_number 可能是1-based)
-        page_segments = [
-            s for s in segments 
-            if s.get("metadata", {}).get("page_number") == page_number
-        ]
+        # 1. 加载 Segments：最优先是 SoA 坐标缓存（segments.npz），
+        # 其次按页分组索引，最后才退回全量 JSON 过滤
+        soa = None
+        page_segments: list = []
+        npz_path = get_segments_npz_path(file_id)
+        if npz_path.exists():
+            try:
+                soa = np.load(npz_path)
+            except Exception as e:
+                print(f"⚠️ segments.npz 读取失败，退回 JSON: {e}")
+                soa = None
+
+        by_page_path = get_segments_by_page_path(file_id)
+        if soa is not None:
+            pass
+        elif by_page_path.exists():
+            page_segments = jsonio.loads(by_page_path.read_bytes()).get(str(page_number), [])
+        else:
+            # 旧解析产物：退回全量过滤
+            seg_path = get_segments_path(file_id)
+            if not seg_path.exists():
+                return None
+
+            segments = jsonio.loads(seg_path.read_bytes())
+
+            # 筛选当前页的 segments (注意 unstructured 的 page_number 可能是1-based)
+            page_segments = [
+                s for s in segments
+                if s.get("metadata", {}).get("page_number") == page_number
+            ]
         
         if not page_segments:
             # 该页没有识别出元素，或者页码不对？
@@ -449,23 +909,19 @@ def render_parsed_page(file_id: str, page_number: int) -> Optional[bytes]:
             return None
             
         page = doc[page_number - 1]
-        pix = page.get_pixmap()
-        pil_image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        
-        # 3. 绘图 (Matplotlib)
-        # 保持图像原始比例，1px = 1 unit?
-        # Matplotlib默认DPI=100. figsize=(w_inch, h_inch).
-        # 为了精确对齐，我们直接用像素尺寸。
+        # alpha=False：预览底图不需要透明通道，省 1/3 缓冲体积
+        pix = page.get_pixmap(alpha=False, colorspace=fitz.csRGB)
+        # frombuffer + samples_mv：直接挂在 Pixmap 的底层缓冲上建 PIL 图，
+        # 跳过 pix.samples 物化 bytes 再 frombytes 整帧拷贝的那一次分配
+        pil_image = Image.frombuffer(
+            "RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", 0, 1)
         
+        # 3. 绘图 (PIL)：直接在页面位图上描多边形。
+        # 之前为了画几个框要起一整套 Matplotlib Figure/Canvas/Agg，
+        # 每次渲染数百毫秒纯 Python 开销；ImageDraw 是同一张图上的原位绘制
         width_px, height_px = pix.width, pix.height
-        dpi = 100
-        fig = Figure(figsize=(width_px / dpi, height_px / dpi), dpi=dpi)
-        # 去除边距
-        ax = fig.add_axes([0, 0, 1, 1])
-        ax.axis("off")
-        
-        ax.imshow(pil_image)
-        
+        draw = ImageDraw.Draw(pil_image)
+
         category_to_color = {
             "Title": "orchid",
             "Image": "forestgreen", 
@@ -473,7 +929,23 @@ def render_parsed_page(file_id: str, page_number: int) -> Optional[bytes]:
             "Header": "orange",
             "Footer": "gray"
         }
-        
+
+        if soa is not None:
+            idx = np.nonzero(soa["page"] == page_number)[0]
+            if idx.size:
+                offsets = soa["pt_offset"]
+                cats = soa["category"]
+                points = soa["points"]
+                scale = (np.array([width_px, height_px], dtype=np.float32)
+                         / soa["layout_wh"][idx[0]])
+                for i in idx:
+                    # 每个多边形一次广播缩放，循环体只剩 draw 调度
+                    poly = (points[offsets[i]:offsets[i + 1]] * scale).tolist()
+                    box_color = category_to_color.get(str(cats[i]), "deepskyblue")
+                    draw.polygon([tuple(p) for p in poly],
+                                 outline=box_color, width=2)
+
+        scale = None
         for segment in page_segments:
             # 检查是否有坐标
             if "coordinates" not in segment.get("metadata", {}):
@@ -486,39 +958,30 @@ def render_parsed_page(file_id: str, page_number: int) -> Optional[bytes]:
             
             if not points or not layout_w or not layout_h:
                 continue
-                
-            # 坐标转换：Layout -> Image Pixel
-            # unstructured points are usually top-left, bottom-left... polygon?
-            # points is list of (x, y).
-            
-            scaled_points = [
-                (x * width_px / layout_w, y * height_px / layout_h)
-                for x, y in points
-            ]
-            
+
+            # 坐标转换：Layout -> Image Pixel。
+            # numpy 广播一次算完整个多边形的顶点，替代逐顶点的 Python 乘法；
+            # 缩放系数同一页内恒定，首个 segment 时算一次即可
+            if scale is None:
+                scale = np.array([width_px / layout_w, height_px / layout_h],
+                                 dtype=np.float32)
+            scaled_points = (np.asarray(points, dtype=np.float32) * scale).tolist()
+
             category = segment.get("category", "Uncategorized")
             box_color = category_to_color.get(category, "deepskyblue")
-            
-            poly = patches.Polygon(
-                scaled_points, 
-                linewidth=2, 
-                edgecolor=box_color, 
-                facecolor="none"
-            )
-            ax.add_patch(poly)
-            
+
+            draw.polygon([tuple(p) for p in scaled_points], outline=box_color, width=2)
+
             # 可选：绘制标签文字
-            # x0, y0 = scaled_points[0]
-            # ax.text(x0, y0, category, color=box_color, fontsize=8, backgroundcolor="white")
+            # draw.text(scaled_points[0], category, fill=box_color)
 
-        # 渲染到 Buffer
-        canvas = FigureCanvasAgg(fig)
+        # 渲染到 Buffer（中间产物，压缩级别调低换编码速度）
         buf = io.BytesIO()
-        canvas.print_png(buf)
+        pil_image.save(buf, "PNG", compress_level=1)
         img_data = buf.getvalue()
         buf.close()
         doc.close()
-        
+
         return img_data
         
     except Exception as e:
@@ -547,7 +1010,7 @@ if __name__ == "__main__":
     # 注意：确保已安装依赖：pip install requests pymupdf pillow langchain-unstructured unstructured html2text python-dotenv
     
     parser = argparse.ArgumentParser(description="PDF 转 Markdown + VLM 图像理解 测试工具")
-    parser.add_argument("--strategy", type=str, default="fast", choices=["fast", "hi_res"], help="解析策略: fast(快速) 或 hi_res(高精度/带OCR)")
+    parser.add_argument("--strategy", type=str, default="fast", choices=["fast", "hi_res", "ocr_only"], help="解析策略: fast(快速) / hi_res(高精度/带OCR) / ocr_only(批量OCR)")
     parser.add_argument("--file_id", type=str, default="test_001", help="测试文件夹名称")
     parser.add_argument("--data_root", type=str, default="data", help="数据根目录")
     args = parser.parse_args()
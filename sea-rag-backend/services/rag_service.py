@@ -1,7 +1,11 @@
 # services/rag_service.py
 from __future__ import annotations
-import os, asyncio, textwrap
+import os, asyncio, io, random, textwrap
 import argparse
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Tuple, AsyncGenerator, Optional
 from typing_extensions import TypedDict
 
@@ -12,33 +16,129 @@ from langchain.chat_models import init_chat_model
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from collections import defaultdict
+import faiss
+import numpy as np
+from collections import OrderedDict, deque
 from pathlib import Path
 
-# 存储结构：sessions[session_id] = [{"role":"user|assistant","content":"..."}...]
-_sessions: dict[str, list[dict]] = defaultdict(list)
+try:
+    from services import index_service as _index_service
+except ImportError:  # 直接以脚本方式运行本文件时
+    import index_service as _index_service
+
+# 会话存储：LRU 容量上限 + TTL 过期 + 每会话轮次截断。
+# 之前的 defaultdict(list) 对弃置会话永不回收，长跑进程等于内存泄漏。
+# 消息存 (role, content) 元组而非 dict，单条省 ~100B；deque(maxlen) 自动
+# 截断到最近 N 条，历史 prompt 也不会无限膨胀
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))  # 秒
+SESSION_MAX_MSGS = 20  # 每会话保留的最近消息条数
+
+# 多 worker 部署（uvicorn --workers N）下进程内 dict 会让历史依赖
+# sticky session；配置 REDIS_URL 后改走 Redis + msgpack（比 JSON 小且快），
+# 未配置或依赖缺失则继续用单进程内存储
+try:
+    import redis as _redis_mod
+    import msgpack as _msgpack
+except ImportError:
+    _redis_mod = None
+    _msgpack = None
+
+_REDIS = None
+_redis_url = os.getenv("REDIS_URL", "")
+if _redis_url and _redis_mod is not None and _msgpack is not None:
+    try:
+        _REDIS = _redis_mod.Redis.from_url(_redis_url, socket_timeout=1.0)
+        _REDIS.ping()
+        print(f"✅ 会话历史使用 Redis: {_redis_url}")
+    except Exception as e:
+        print(f"⚠️ Redis 连接失败（{e}），会话历史回退进程内存储")
+        _REDIS = None
+elif _redis_url:
+    print("⚠️ 已配置 REDIS_URL 但缺少 redis/msgpack 依赖，会话历史回退进程内存储")
+
+# session_id -> [last_access_ts, deque[(role, content)]]
+_sessions: "OrderedDict[str, list]" = OrderedDict()
+_SESSIONS_LOCK = threading.Lock()
 
 def get_history(session_id: str) -> list[dict]:
-    return _sessions.get(session_id, [])
+    if _REDIS is not None:
+        try:
+            raw = _REDIS.lrange(f"sess:{session_id}", -SESSION_MAX_MSGS, -1)
+            return [
+                {"role": r, "content": c}
+                for r, c in (_msgpack.unpackb(x, raw=False) for x in raw)
+            ]
+        except Exception as e:
+            print(f"⚠️ Redis 读取会话失败（{e}），降级内存存储")
+    with _SESSIONS_LOCK:
+        item = _sessions.get(session_id)
+        if item is None:
+            return []
+        if time.time() - item[0] > SESSION_TTL:
+            del _sessions[session_id]
+            return []
+        _sessions.move_to_end(session_id)
+        # 对外仍是 chat-message dict 形态（直接拼进 LLM messages）
+        return [{"role": r, "content": c} for r, c in item[1]]
 
 def append_history(session_id: str, role: str, content: str) -> None:
-    _sessions[session_id].append({"role": role, "content": content})
+    if _REDIS is not None:
+        try:
+            key = f"sess:{session_id}"
+            # pipeline 一次往返完成 追加 + 续期 + 截断
+            pipe = _REDIS.pipeline(transaction=False)
+            pipe.rpush(key, _msgpack.packb((role, content), use_bin_type=True))
+            pipe.expire(key, SESSION_TTL)
+            pipe.ltrim(key, -SESSION_MAX_MSGS, -1)
+            pipe.execute()
+            return
+        except Exception as e:
+            print(f"⚠️ Redis 写入会话失败（{e}），降级内存存储")
+    now = time.time()
+    with _SESSIONS_LOCK:
+        item = _sessions.get(session_id)
+        if item is None or now - item[0] > SESSION_TTL:
+            item = [now, deque(maxlen=SESSION_MAX_MSGS)]
+            _sessions[session_id] = item
+        item[0] = now
+        item[1].append((role, content))
+        _sessions.move_to_end(session_id)
+        while len(_sessions) > SESSION_MAX:
+            _sessions.popitem(last=False)  # LRU 淘汰最久未用的会话
 
 def clear_history(session_id: str) -> None:
-    _sessions.pop(session_id, None)
+    if _REDIS is not None:
+        try:
+            _REDIS.delete(f"sess:{session_id}")
+            return
+        except Exception as e:
+            print(f"⚠️ Redis 清理会话失败（{e}）")
+    with _SESSIONS_LOCK:
+        _sessions.pop(session_id, None)
 
 # ---------------- 配置 ----------------
 # 请根据实际情况调整模型名称
 MODEL_NAME = os.getenv("CHAT_MODEL_NAME", "deepseek-ai/DeepSeek-V3")
+# 分层路由：简单问题走小模型，DeepSeek-V3 只留给重推理流量
+SMALL_MODEL_NAME = os.getenv("SMALL_CHAT_MODEL_NAME", "Qwen/Qwen2.5-7B-Instruct")
 SILICON_BASE_URL = os.getenv("SILICON_BASE_URL", "https://api.siliconflow.cn/v1")
 MODEL_PROVIDER = "openai" # SiliconFlow 兼容 OpenAI 接口
 TEMPERATURE = 0.3
 
 K = 5 # 增加召回数量以支持多文档
-SCORE_TAU_TOP1 = 0.50 # 稍微放宽阈值
-SCORE_TAU_MEAN3 = 0.65
-
-SCORE_TAU_MEAN3 = 0.65
+# context 总量预算（字符数 ≈ 2x token 数）：prefill 是计算瓶颈，
+# 上限防止 K 调大（如引入 rerank 后取 20）时 prompt 线性膨胀
+CTX_BUDGET = int(os.getenv("CTX_BUDGET", "8000"))
+# token 事件合并窗口：每个 LLM token 一个 yield + 一帧 SSE 的调度开销
+# 在长回答下可观；攒满字符数或超时即冲刷，前端感知不到 30ms 的粒度
+TOKEN_BATCH_CHARS = 64
+TOKEN_BATCH_SECS = 0.03
+# IVF 索引每次查询扫描的聚类数（召回率/延迟权衡），与 index_service 共用同一环境变量
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+# 全局索引为内积/余弦语义（向量已归一化），分数越高越相关。
+# 历史硬阈值 top1>=0.50 / mean3>=0.35 已被 _relevance_prob 的
+# logistic 判别取代（默认系数即按这组阈值校准）
 DATA_ROOT = Path(os.getenv("DATA_ROOT", "data")).resolve()
 GLOBAL_INDEX_DIR = DATA_ROOT / "global_index"
 
@@ -74,26 +174,89 @@ ANSWER_NO_CONTEXT = (
     "问题：\n{question}"
 )
 
+# 静态 prompt 片段在进程启动时定型：
+# - system 消息是复用的冻结 dict，且永远是消息序列第一条——
+#   SiliconFlow/DeepSeek 的上下文缓存按「字节一致的前缀」命中，
+#   静态 preamble 放最前能让 provider 端从 KV cache 直接复用 prefill
+#   （OpenAI 兼容接口没有显式 cache_control 字段，靠前缀一致自动命中）；
+# - 模板预切成常量片段，请求期用纯拼接替代 str.format 的逐次模板扫描
+_SYSTEM_MSG = {"role": "system", "content": SYSTEM_INSTRUCTION}
+
+_AWC_PRE, _awc_rest = ANSWER_WITH_CONTEXT.split("{question}", 1)
+_AWC_MID, _AWC_POST = _awc_rest.split("{context}", 1)
+_ANC_PRE, _ANC_POST = ANSWER_NO_CONTEXT.split("{question}", 1)
+_GRADE_PRE, _grade_rest = GRADE_PROMPT.split("{context}", 1)
+_GRADE_MID, _GRADE_POST = _grade_rest.split("{question}", 1)
+
 
 # ---------------- 模型/向量函数 ----------------
-def _get_llm():
-    return init_chat_model(
-        model=MODEL_NAME, 
-        model_provider=MODEL_PROVIDER, 
-        openai_api_base=SILICON_BASE_URL,
-        temperature=TEMPERATURE
-    )
+# Chat 模型单例：init_chat_model 每次都会重建 AsyncOpenAI 客户端
+# （连接池、env 解析、模型名解析），每请求数十 ms 纯开销，还丢掉
+# 跨请求的 HTTP keep-alive。懒初始化一次，后续请求复用同一客户端/连接池
+_LLM_SINGLETONS = {"big": None, "small": None}
+_GRADER_SINGLETON = None
+
+# 重推理特征词：命中任一则必须走大模型
+_BIG_MODEL_HINTS = (
+    "为什么", "分析", "比较", "对比", "推导", "解释", "评价", "总结", "区别",
+    "why", "how", "compare", "explain", "analyz", "summariz", "difference",
+)
 
-def _get_grader():
-    return init_chat_model(
-        model=MODEL_NAME, 
-        model_provider=MODEL_PROVIDER, 
-        openai_api_base=SILICON_BASE_URL,
-        temperature=0
-    )
+def _classify_complexity(question: str, context_len: int) -> str:
+    """百微秒级的规则路由：factoid/短问题 → small，重推理/长上下文 → big。"""
+    if context_len > 4000:
+        return "big"  # 长 prefill 下小模型容易丢 context
+    if len(question) > 64:
+        return "big"
+    q = question.lower()
+    if any(h in q for h in _BIG_MODEL_HINTS):
+        return "big"
+    return "small"
+
+def _get_llm(tier: str = "big"):
+    if _LLM_SINGLETONS[tier] is None:
+        with _INIT_LOCK:
+            if _LLM_SINGLETONS[tier] is None:
+                _LLM_SINGLETONS[tier] = init_chat_model(
+                    model=MODEL_NAME if tier == "big" else SMALL_MODEL_NAME,
+                    model_provider=MODEL_PROVIDER,
+                    openai_api_base=SILICON_BASE_URL,
+                    temperature=TEMPERATURE
+                )
+    return _LLM_SINGLETONS[tier]
 
-def _get_embeddings():
+def _get_grader():
+    global _GRADER_SINGLETON
+    if _GRADER_SINGLETON is None:
+        with _INIT_LOCK:
+            if _GRADER_SINGLETON is None:
+                _GRADER_SINGLETON = init_chat_model(
+                    model=MODEL_NAME,
+                    model_provider=MODEL_PROVIDER,
+                    openai_api_base=SILICON_BASE_URL,
+                    temperature=0
+                )
+    return _GRADER_SINGLETON
+
+# 进程级单例：embedding 模型加载是数百 MB + 秒级的 PyTorch 冷启动，
+# 索引加载是整文件读盘反序列化，二者都不该出现在每次 retrieve() 的热路径上。
+# 锁防止并发首请求惊群式重复加载；索引缓存以 index.faiss 的 mtime 为键，
+# 新文件入库重建索引后自动失效
+_INIT_LOCK = threading.Lock()
+_EMB_CACHE = None
+_VS_CACHE: Dict[str, Any] = {"key": None, "vs": None}
+
+def _build_embeddings():
     """优先使用本地 BGE 模型，失败回退到 OpenAI"""
+    # 首选：与 index_service 共用同一个模型单例。查询向量和入库向量
+    # 保证同源，一个进程只驻留一份权重；其 EMBEDDING_BACKEND=onnx 开关
+    # 还能切到 ONNX Runtime + int8/VNNI 量化推理（CPU 上 2~4 倍吞吐；
+    # optimum-cli 导出的量化产物用 ONNX_MODEL_FILE 指定）
+    try:
+        return _index_service.load_embeddings()
+    except Exception as e:
+        print(f"⚠️ 共享 Embedding 单例获取失败: {e}，本地兜底构建")
+
     embedding_model = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-small-zh-v1.5")
     try:
         return HuggingFaceBgeEmbeddings(
@@ -110,143 +273,509 @@ def _get_embeddings():
             model=openai_model,
         )
 
+def _get_embeddings():
+    global _EMB_CACHE
+    if _EMB_CACHE is None:
+        with _INIT_LOCK:
+            if _EMB_CACHE is None:  # double-check：拿锁期间可能已被别人建好
+                _EMB_CACHE = _build_embeddings()
+    return _EMB_CACHE
+
 def _load_global_vs() -> FAISS:
-    """加载全局索引"""
-    if not (GLOBAL_INDEX_DIR / "index.faiss").exists():
+    """加载全局索引（mtime 失效的进程级缓存）"""
+    index_path = GLOBAL_INDEX_DIR / "index.faiss"
+    if not index_path.exists():
         raise FileNotFoundError(f"Global FAISS index not found at {GLOBAL_INDEX_DIR}; please run ingestion first.")
-    
-    # allow_dangerous_deserialization=True is needed for locally saved FAISS
-    return FAISS.load_local(str(GLOBAL_INDEX_DIR), _get_embeddings(), allow_dangerous_deserialization=True)
 
-def _score_ok(scores: List[float]) -> bool:
+    key = index_path.stat().st_mtime_ns
+    if _VS_CACHE["key"] == key and _VS_CACHE["vs"] is not None:
+        return _VS_CACHE["vs"]
+
+    with _INIT_LOCK:
+        if _VS_CACHE["key"] == key and _VS_CACHE["vs"] is not None:
+            return _VS_CACHE["vs"]
+        # 复用 index_service 的只读加载：faiss 索引走 mmap
+        # （IO_FLAG_MMAP | IO_FLAG_READ_ONLY），多 worker 部署时各进程
+        # 共享同一份页缓存，RSS 约等于一份索引而非 N 份；
+        # 内部已带 load_local 兜底（mmap 失败 / 旧格式）
+        vs = _index_service.load_global_vs_readonly(_get_embeddings())
+        # 入库侧（index_service）对大库建的是 OPQ/IVF/PQ 近似索引：
+        # 加载后设好 nprobe，检索从 O(N·d) 穷举降到只扫若干聚类
+        try:
+            faiss.extract_index_ivf(vs.index).nprobe = FAISS_NPROBE
+        except RuntimeError:
+            pass  # Flat 小索引没有 nprobe，穷举本来就够快
+        if _VS_CACHE["vs"] is not None and _VS_CACHE["key"] != key:
+            # 索引换代（重建/追加/删除文件）：语义缓存里的 citations
+            # 与答案都基于旧索引内容，必须整体失效，否则复述命中会
+            # 一直重放指向已删文件的预览链接
+            _sem_cache_clear()
+        _VS_CACHE["key"] = key
+        _VS_CACHE["vs"] = vs
+    return vs
+
+@functools.lru_cache(maxsize=4096)
+def _embed_query_cached(text: str) -> tuple:
+    """查询向量 LRU：同一问题（重试/语义缓存探测/检索）只跑一次 BGE 前向。
+    缓存值存不可变 tuple，避免被调用方原地改动。"""
+    return tuple(_get_embeddings().embed_query(text))
+
+def _prewarm_page_cache() -> None:
+    """
+    并行顺序读一遍索引目录下的文件，把冷页提前拽进 OS page cache。
+    load_local 是单线程顺序读；网络盘（NFS/EFS）上多流并读能把
+    冷启动读盘时间压到 1/并发数，本地盘上命中页缓存也只赚不亏。
+    """
+    try:
+        files = [p for p in GLOBAL_INDEX_DIR.iterdir() if p.is_file()]
+    except OSError:
+        return
+    if not files:
+        return
+
+    def _read(p: Path):
+        try:
+            with open(p, "rb") as f:
+                while f.read(1 << 22):  # 4MB 块顺序读，只为触发预取
+                    pass
+        except OSError:
+            pass
+
+    with ThreadPoolExecutor(max_workers=min(8, len(files))) as ex:
+        list(ex.map(_read, files))
+
+async def warmup() -> None:
+    """启动时预热：把模型加载和索引读盘的冷启动成本挪到首个请求之前"""
+    def _sync():
+        _prewarm_page_cache()
+        _get_embeddings()
+        try:
+            _load_global_vs()
+        except FileNotFoundError:
+            print("⚠️ 预热：全局索引尚不存在，跳过")
+    await asyncio.to_thread(_sync)
+    print("✅ RAG 预热完成 (embedding 模型 + 全局索引)")
+
+# ---------------- 语义缓存 ----------------
+# 同义复述的问题（"如何维护声呐?" vs "声呐怎么保养?"）不该重复付
+# FAISS 检索 + LLM 流式生成的成本。以查询向量为键做近邻匹配：
+# 相似度过阈值即复用此前的 (citations, context, answer)
+SEM_CACHE_TAU = float(os.getenv("SEM_CACHE_TAU", "0.92"))
+SEM_CACHE_MAX = int(os.getenv("SEM_CACHE_MAX", "10000"))
+
+_SEM_LOCK = threading.Lock()
+_SEM_INDEX = None  # faiss.IndexIDMap(IndexFlatIP)，维度取决于模型，懒建
+_SEM_ENTRIES: "OrderedDict[int, dict]" = OrderedDict()
+_SEM_NEXT_ID = 0
+
+def _sem_cache_clear() -> None:
+    """清空语义缓存。索引重建/文件删除后旧的 citations、预览链接和
+    答案全部失效，整体作废比逐条甄别便宜且绝对安全。"""
+    global _SEM_INDEX, _SEM_NEXT_ID
+    with _SEM_LOCK:
+        if _SEM_ENTRIES:
+            print(f"[SemCache] 索引版本变化，清空 {len(_SEM_ENTRIES)} 条缓存")
+        _SEM_INDEX = None
+        _SEM_ENTRIES.clear()
+        _SEM_NEXT_ID = 0
+
+def _sem_cache_probe(qvec: List[float], file_id: Optional[str] = None) -> Optional[dict]:
+    """近邻查缓存；file_id 不同（检索范围不同）的条目不算命中"""
+    with _SEM_LOCK:
+        if _SEM_INDEX is None or _SEM_INDEX.ntotal == 0:
+            return None
+        q = np.asarray(qvec, dtype=np.float32)[None, :]
+        scores, ids = _SEM_INDEX.search(q, 1)
+        if ids[0][0] < 0 or scores[0][0] < SEM_CACHE_TAU:
+            return None
+        entry = _SEM_ENTRIES.get(int(ids[0][0]))
+        if entry is None or entry.get("file_id") != file_id:
+            return None
+        return entry
+
+def _sem_cache_add(qvec: List[float], entry: dict) -> None:
+    """入缓存；超出容量时按 FIFO 淘汰最老条目（索引同步 remove_ids）"""
+    global _SEM_INDEX, _SEM_NEXT_ID
+    q = np.asarray(qvec, dtype=np.float32)[None, :]
+    with _SEM_LOCK:
+        if _SEM_INDEX is None:
+            _SEM_INDEX = faiss.IndexIDMap(faiss.IndexFlatIP(q.shape[1]))
+        sid = _SEM_NEXT_ID
+        _SEM_NEXT_ID += 1
+        _SEM_INDEX.add_with_ids(q, np.array([sid], dtype=np.int64))
+        _SEM_ENTRIES[sid] = entry
+        if len(_SEM_ENTRIES) > SEM_CACHE_MAX:
+            old_id, _ = _SEM_ENTRIES.popitem(last=False)
+            _SEM_INDEX.remove_ids(np.array([old_id], dtype=np.int64))
+
+# 轻量相关性判别：logistic 模型替代每次 borderline 都请 Grader LLM
+# （一次 1~3s 的往返）。特征 (top1, mean3, top1-mean3, hit_count,
+# question_len/100)，推理 <1µs；只有落在不确定带 (LO, HI) 内的查询才
+# 再起后台 Grader 裁决。系数可用离线标注重新拟合后通过 env 覆盖，
+# 默认值按旧硬阈值手工校准（p=0.5 等价 top1>=0.50 / mean3>=0.35 门限）
+GRADER_BAND_LO = float(os.getenv("GRADER_BAND_LO", "0.4"))
+GRADER_BAND_HI = float(os.getenv("GRADER_BAND_HI", "0.6"))
+_GRADER_COEFS = np.array(
+    [float(x) for x in os.getenv("GRADER_COEFS", "10.0,8.0,0.0,0.0,0.0").split(",")],
+    dtype=np.float32,
+)
+_GRADER_BIAS = float(os.getenv("GRADER_BIAS", "-7.8"))
+
+def _relevance_prob(scores: List[float], question: str) -> float:
     if not scores:
-        return False
-    top1 = scores[0]
-    mean3 = sum(scores[:3]) / min(3, len(scores))
-    return (top1 <= SCORE_TAU_TOP1) or (mean3 <= SCORE_TAU_MEAN3)
+        return 0.0
+    # 一次 fromiter 进 ndarray，top1/mean3 都在 C 层算完
+    arr = np.fromiter(scores, dtype=np.float32, count=len(scores))
+    top1 = float(arr[0])
+    mean3 = float(arr[:3].mean())
+    feats = np.array(
+        [top1, mean3, top1 - mean3, float(len(arr)), min(len(question), 100) / 100.0],
+        dtype=np.float32,
+    )
+    z = _GRADER_BIAS + float(_GRADER_COEFS @ feats)
+    return float(1.0 / (1.0 + np.exp(-z)))
 
 # ---------------- 主流程：检索 + 判定 + 生成 ----------------
-async def retrieve(question: str, file_id: Optional[str] = None) -> tuple[list[dict], str]:
+async def retrieve(question: str, file_id: Optional[str] = None) -> tuple[list[dict], str, Optional[asyncio.Task]]:
     """
-    检索函数。
+    检索函数。返回 (citations, context_text, grader_task)。
     :param file_id: 若提供，则仅检索该文件；否则检索全局知识库。
+    grader_task 非 None 表示分数处于边界、LLM 裁决仍在后台进行，
+    由 answer_stream 在裁决点 await。
     """
     try:
         vs = _load_global_vs()
     except Exception as e:
         print(f"Index load error: {e}")
-        return [], ""
-
-    # 构造过滤器
-    search_kwargs = {"k": K}
-    if file_id:
-        # FAISS (LangChain wrapper) 支持 filter 参数
-        # 假设 metadata 中包含 'file_id' 字段
-        search_kwargs["filter"] = {"file_id": file_id}
-        
-    hits = vs.similarity_search_with_score(question, **search_kwargs)
+        return [], "", None
+
+    # 查询只 embed 一次：语义缓存探测和 FAISS 检索共用同一个向量
+    qvec = None
+    try:
+        qvec = list(_embed_query_cached(question))
+    except Exception as e:
+        print(f"Query embedding error: {e}")
+    if qvec is not None:
+        entry = _sem_cache_probe(qvec, file_id)
+        if entry is not None:
+            print(f"[SemCache] 检索缓存命中: {question!r} ≈ {entry['question']!r}")
+            return entry["citations"], entry["context_text"], None
+
+    # by_vector 复用上面算好的 qvec，省掉 similarity_search_with_score
+    # 内部的第二次 BGE 前向（CPU 部署下这是检索延迟的大头）。
+    # file_id 过滤走原生 IDSelector：LangChain 的 filter 是取完 top-k
+    # 再 Python 后过滤，小文件占比低时命中数远少于 K；selector 在
+    # IVF/Flat 扫描阶段裁剪，一次搜索就拿满 K 条真命中
+    sel_ids = None
+    if file_id and qvec is not None:
+        try:
+            sel_ids = _index_service._file_id_vector_ids(vs, file_id)
+        except Exception as e:
+            print(f"⚠️ IDSelector 构建失败（{e}），回退 LangChain 过滤")
+    if file_id and qvec is not None and sel_ids is not None:
+        xq = np.asarray(qvec, dtype=np.float32)[None, :]
+        sel = faiss.IDSelectorBatch(sel_ids)
+        try:
+            D, I = vs.index.search(
+                xq, K, params=faiss.SearchParametersIVF(sel=sel, nprobe=FAISS_NPROBE))
+        except RuntimeError:
+            # 非 IVF 索引（Flat 等）
+            D, I = vs.index.search(xq, K, params=faiss.SearchParameters(sel=sel))
+        hits = [
+            (vs.docstore.search(vs.index_to_docstore_id[int(idx)]), float(score))
+            for idx, score in zip(I[0], D[0]) if idx != -1
+        ]
+    else:
+        search_kwargs = {"k": K}
+        if file_id:
+            # sidecar 不可用时的退路：LangChain dict 过滤
+            search_kwargs["filter"] = {"file_id": file_id}
+        if qvec is not None:
+            hits = vs.similarity_search_with_score_by_vector(qvec, **search_kwargs)
+        else:
+            hits = vs.similarity_search_with_score(question, **search_kwargs)
     
     citations = []
-    ctx_snippets = []
+    # 增量写 StringIO，免去 list + join 的中间对象；超预算后只收
+    # citation（前端展示用），不再往 prompt 里塞
+    ctx_buf = io.StringIO()
+    ctx_chars = 0
     scores = []
-    
+
     for i, (doc, score) in enumerate(hits, start=1):
-        snippet_short = (doc.page_content or "").strip()
+        content = (doc.page_content or "").strip()
         # 截断过长的 context 用于 prompt，但保留原本用于 citation
-        if len(snippet_short) > 500:
-            snippet_short = snippet_short[:500] + "..."
-            
+        snippet_short = content[:500] + "..." if len(content) > 500 else content
+
         meta = doc.metadata
-        f_id = meta.get("file_id", "unknown")
-        source = meta.get("source", f_id)
-        page = meta.get("page", "?")
-        
-        # 构造 Citation 对象
+        tmpl = meta.get("_citation_tmpl")
+        ctx_header = meta.get("_ctx_header")
+        if tmpl is None or ctx_header is None:
+            # 旧索引（没有入库时预构模板）：现场拼
+            f_id = meta.get("file_id", "unknown")
+            source = meta.get("source", f_id)
+            page = meta.get("page", "?")
+            tmpl = {
+                "fileId": f_id,
+                "sourceName": source,
+                "page": page,
+                "previewUrl": f"/api/v1/pdf/page?fileId={f_id}&page={page}&type=original",
+            }
+            ctx_header = f"Document: {source} (Page {page})\nContent: "
+
+        # 构造 Citation 对象：不变部分来自入库时的预构模板，
+        # 热路径只合并 per-query 的 rank/score/snippet
         citations.append({
-            "citation_id": f"{f_id}-c{i}",
-            "fileId": f_id,
-            "sourceName": source,
+            **tmpl,
+            "citation_id": f"{tmpl['fileId']}-c{i}",
             "rank": i,
-            "page": page,
-            "snippet": (doc.page_content or "")[:4000],
+            "snippet": content[:4000],
             "score": float(score),
-            "previewUrl": f"/api/v1/pdf/page?fileId={f_id}&page={page}&type=original",
         })
-        
-        # 构造 Context 文本 (包含元数据以便 LLM 引用)
-        ctx_snippets.append(f"Document: {source} (Page {page})\nContent: {snippet_short}")
+
+        # 构造 Context 文本 (包含元数据以便 LLM 引用)，带总量预算
+        line = ctx_header + snippet_short
+        if ctx_chars == 0 or ctx_chars + 2 + len(line) <= CTX_BUDGET:
+            if ctx_chars > 0:
+                ctx_buf.write("\n\n")
+                ctx_chars += 2
+            ctx_buf.write(line)
+            ctx_chars += len(line)
         scores.append(float(score))
-        
-    context_text = "\n\n".join(ctx_snippets) if ctx_snippets else ""
 
-    # 这里我们简化逻辑：只要有检索结果且分数达标，从 Score 判断即可。
-    # Phase 3 我们主要关注检索逻辑，Grader 暂时保留但作为辅助。
-    ok_by_score = _score_ok(scores)
-    
-    # 也可以选择总是相信检索结果，交给 LLM 决定是否回答
-    # 这里保持原有逻辑：如果分数太差，用 LLM judge 一下
-    ok_by_llm = True
-    if context_text and not ok_by_score:
-        try:
-            grader = _get_grader()
-            grade_prompt = GRADE_PROMPT.format(context=context_text, question=question)
-            decision = await grader.ainvoke([{"role": "user", "content": grade_prompt}])
-            ok_by_llm = "yes" in (decision.content or "").lower()
-        except:
-            ok_by_llm = True # 降级：如果 Grader 失败，倾向于信任检索
+    context_text = ctx_buf.getvalue()
+
+    # 三段式裁决：p >= HI 直接采信检索；p <= LO 直接弃用上下文；
+    # 只有不确定带才请 Grader LLM，且不同步等它（1~3s 会把整条流水线
+    # 堵住）——起后台 Task 即刻返回，answer_stream 在真正需要裁决的
+    # 位置再 await（常见情形是 "yes"，等待和引用推送完全重叠）
+    p_rel = _relevance_prob(scores, question)
+    grader_task: Optional[asyncio.Task] = None
+    if context_text and p_rel <= GRADER_BAND_LO:
+        # 置信否决：连 Grader 都不请，直接走 no_context
+        context_text = ""
+    elif context_text and p_rel < GRADER_BAND_HI:
+        grader_task = asyncio.create_task(_grade(question, context_text))
+
+    print(f"[Retrieval Debug] Query: {question}, Filter: {file_id}, Hits: {len(hits)}, "
+          f"P(rel): {p_rel:.2f}, Grader: {'deferred' if grader_task else 'skipped'}")
+
+    branch = "with_context" if context_text else "no_context"
+    final_context = context_text if branch == "with_context" else ""
+
+    # 回填语义缓存；answer_stream 结束后会把最终回答补进同一条目。
+    # Grader 还没裁决的（borderline 分数）不入缓存，避免缓存住坏上下文
+    if qvec is not None and grader_task is None:
+        _sem_cache_add(qvec, {
+            "question": question,
+            "file_id": file_id,
+            "citations": citations,
+            "context_text": final_context,
+            "answer": None,
+        })
+
+    return citations, final_context, grader_task
 
-    print(f"[Retrieval Debug] Query: {question}, Filter: {file_id}, Hits: {len(hits)}, ScoreOK: {ok_by_score}, LLM_OK: {ok_by_llm}")
+# 后台落盘任务的强引用集合：create_task 的返回值若不持有，
+# 事件循环只存弱引用，任务可能在完成前被 GC（asyncio 文档明确警告）
+_BG_TASKS: set = set()
 
-    branch = "with_context" if (context_text and ok_by_llm) else "no_context"
-    return citations, context_text if branch == "with_context" else ""
+def _persist_turn_bg(session_id: str, question: str, answer: str) -> None:
+    """把本轮问答写入会话历史，不阻塞 done 事件的下发。
+
+    append_history 在 Redis 模式下是一次网络往返，放到线程池里
+    fire-and-forget；内存模式下开销可忽略但路径统一。
+    """
+    async def _persist():
+        await asyncio.to_thread(append_history, session_id, "user", question)
+        await asyncio.to_thread(append_history, session_id, "assistant", answer)
+
+    task = asyncio.create_task(_persist())
+    _BG_TASKS.add(task)
+    task.add_done_callback(_BG_TASKS.discard)
+
+async def _grade(question: str, context_text: str) -> bool:
+    """LLM 相关性裁决（异步任务体）。失败时倾向于信任检索结果。"""
+    try:
+        grader = _get_grader()
+        grade_prompt = _GRADE_PRE + context_text + _GRADE_MID + question + _GRADE_POST
+        decision = await grader.ainvoke([{"role": "user", "content": grade_prompt}])
+        return "yes" in (decision.content or "").lower()
+    except:
+        return True # 降级：如果 Grader 失败，倾向于信任检索
 
 async def answer_stream(
     question: str,
     citations: list[dict],
     context_text: str,
     branch: str,
-    session_id: str | None = None
+    session_id: str | None = None,
+    grader_task: "asyncio.Task | None" = None
 ) -> AsyncGenerator[dict, None]:
-    
+
     # 1. 发送 Citations
     if branch == "with_context" and citations:
         for c in citations:
             yield {"type": "citation", "data": c}
 
-    llm = _get_llm()
-    history_msgs = get_history(session_id) if session_id else []
-
-    if branch == "with_context" and context_text:
-        user_prompt = ANSWER_WITH_CONTEXT.format(question=question, context=context_text)
-    else:
-        user_prompt = ANSWER_NO_CONTEXT.format(question=question)
-
-    msgs = [{"role": "system", "content": SYSTEM_INSTRUCTION}]
-    msgs.extend(history_msgs)
-    msgs.append({"role": "user", "content": user_prompt})
+    # 2. 语义缓存：近似重复的问题且上下文完全一致时，直接重放已存回答
+    sem_entry = None
+    if branch == "with_context":
+        try:
+            # retrieve 刚嵌入过同一问题，这里是纯 lru_cache 字典命中
+            qv = list(_embed_query_cached(question))
+            sem_entry = _sem_cache_probe(qv)
+        except Exception:
+            sem_entry = None
+        if sem_entry is not None and sem_entry.get("context_text") != context_text:
+            sem_entry = None  # 上下文变了（索引更新等），不能重放也不回填
+        if sem_entry is not None and sem_entry.get("answer"):
+            print(f"[SemCache] 回答缓存命中: {question!r}")
+            if grader_task is not None:
+                grader_task.cancel()  # 重放缓存答案，裁决不再需要
+            yield {"type": "token", "data": sem_entry["answer"]}
+            if session_id:
+                _persist_turn_bg(session_id, question, sem_entry["answer"])
+            yield {"type": "done", "data": {"used_retrieval": True}}
+            return
+
+    tier = _classify_complexity(question, len(context_text))
+    llm = _get_llm(tier)
+    if tier == "small":
+        print(f"[Router] 简单问题，路由到小模型 {SMALL_MODEL_NAME}")
+    # Redis 模式下 get_history 是一次同步网络往返（socket_timeout 最长
+    # 1s），不能压在事件循环上挡住首 token；与 _persist_turn_bg 一样
+    # 丢线程池执行
+    history_msgs = (await asyncio.to_thread(get_history, session_id)) if session_id else []
 
     final_text_parts: list[str] = []
 
-    try:
-        async for chunk in llm.astream(msgs):
-            delta = getattr(chunk, "content", None)
-            if delta:
-                final_text_parts.append(delta)
-                yield {"type": "token", "data": delta}
-    except Exception as e:
-        print(f"Error in stream: {e}")
-        resp = await llm.ainvoke(msgs)
-        text = resp.content or ""
-        final_text_parts.append(text)
-        yield {"type": "token", "data": text}
+    # 乐观预填充（prefill-overlap）：分数边界时 Grader 还在后台跑，
+    # 不等它 —— 直接按 with_context 起流，让 provider 的 prefill 与裁决
+    # 并行；裁决落定前产出的 token 压在 held 缓冲里不外发。
+    # 通过（常见）：缓冲并入正常批量下发，TTFT 省掉整个裁决等待；
+    # 否决（罕见）：关流废弃缓冲，换 no_context prompt 走第二遍
+    for _pass in (0, 1):
+        if branch == "with_context" and context_text:
+            user_prompt = _AWC_PRE + question + _AWC_MID + context_text + _AWC_POST
+        else:
+            user_prompt = _ANC_PRE + question + _ANC_POST
+
+        msgs = [_SYSTEM_MSG]
+        msgs.extend(history_msgs)
+        msgs.append({"role": "user", "content": user_prompt})
+
+        final_text_parts = []
+        held: list[str] = []
+        holding = grader_task is not None and branch == "with_context"
+        rejected = False
+
+        # 逐 token yield 改为窗口合并：N 个 token 的 Python 级分发降到 ~N/20
+        buf: list[str] = []
+        buf_len = 0
+        last_flush = time.monotonic()
+
+        # 流式失败多为瞬时网络抖动：带抖动退避重试一次流，客户端保住
+        # TTFT；两次都失败才退化到整段 ainvoke。已外发过 token 则不重试
+        # （会重复输出），4xx 属确定性错误也不重试
+        emitted = False
+        for attempt in (0, 1):
+            try:
+                agen = llm.astream(msgs)
+                async for chunk in agen:
+                    delta = getattr(chunk, "content", None)
+                    if not delta:
+                        continue
+                    if holding:
+                        if not grader_task.done():
+                            held.append(delta)
+                            continue
+                        holding = False
+                        try:
+                            ok_by_llm = grader_task.result()
+                        except Exception:
+                            ok_by_llm = True
+                        if not ok_by_llm:
+                            rejected = True
+                            await agen.aclose()
+                            break
+                        held.append(delta)
+                        delta = "".join(held)
+                        held.clear()
+                    final_text_parts.append(delta)
+                    buf.append(delta)
+                    buf_len += len(delta)
+                    now = time.monotonic()
+                    if buf_len >= TOKEN_BATCH_CHARS or now - last_flush >= TOKEN_BATCH_SECS:
+                        yield {"type": "token", "data": "".join(buf)}
+                        emitted = True
+                        buf.clear()
+                        buf_len = 0
+                        last_flush = now
+                if holding and not rejected:
+                    # 整条流比裁决还快（短回答）：此时只能等结论
+                    try:
+                        ok_by_llm = await grader_task
+                    except Exception:
+                        ok_by_llm = True
+                    if ok_by_llm:
+                        joined = "".join(held)
+                        final_text_parts.append(joined)
+                        buf.append(joined)
+                    else:
+                        rejected = True
+                if not rejected and buf:
+                    yield {"type": "token", "data": "".join(buf)}
+                    buf.clear()
+                break
+            except Exception as e:
+                status = getattr(e, "status_code", None) or getattr(
+                    getattr(e, "response", None), "status_code", None)
+                retryable = not (isinstance(status, int) and 400 <= status < 500)
+                if attempt == 0 and retryable and not emitted:
+                    print(f"⚠️ 流式请求失败（{e}），退避后重试")
+                    await asyncio.sleep(0.1 + random.random() * 0.2)
+                    # 重置本次尝试的中间状态再重放
+                    final_text_parts = []
+                    held.clear()
+                    holding = grader_task is not None and branch == "with_context"
+                    buf.clear()
+                    buf_len = 0
+                    last_flush = time.monotonic()
+                    continue
+                print(f"Error in stream: {e}")
+                resp = await llm.ainvoke(msgs)
+                text = resp.content or ""
+                final_text_parts.append(text)
+                yield {"type": "token", "data": text}
+                break
+
+        if not rejected:
+            break
+        # 第二遍：否决后的 no_context 重发
+        print(f"[Grader] 判定上下文不相关，废弃预填充，转 no_context: {question!r}")
+        branch = "no_context"
+        context_text = ""
+        grader_task = None
+        sem_entry = None
 
     # 尾部可以追加相关图片(如果 Citations 里有)，但现在的 Prompt 已经让 LLM 内联了。
     # 保留此逻辑以防 LLM 没插入
     # ... (可选)
 
+    final_text = "".join(final_text_parts)
+
+    # 回答写回语义缓存条目（retrieve 已登记，这里只补 answer 字段）。
+    # 仅在无会话历史时回填：带历史生成的回答是会话条件化的
+    # （「如前所述…」甚至引用了该会话此前的内容），跨会话重放既答非
+    # 所问，也会把 A 会话的对话内容泄漏给 B
+    if (sem_entry is not None and not sem_entry.get("answer")
+            and final_text and not history_msgs):
+        sem_entry["answer"] = final_text
+
     if session_id:
-        append_history(session_id, "user", question)
-        append_history(session_id, "assistant", "".join(final_text_parts))
+        # fire-and-forget：历史落盘不挡 done 事件（客户端收尾延迟）
+        _persist_turn_bg(session_id, question, final_text)
 
     yield {"type": "done", "data": {"used_retrieval": branch == "with_context"}}
 
@@ -265,7 +794,7 @@ if __name__ == "__main__":
             print(f">>> 范围: 全局知识库")
         
         # 1. 检索
-        citations, ctx_text = await retrieve(args.question, args.file_id)
+        citations, ctx_text, grader_task = await retrieve(args.question, args.file_id)
         print(f">>> 检索结果: {len(citations)} 条引用")
         
         if citations:
@@ -278,7 +807,8 @@ if __name__ == "__main__":
         # 2. 生成回答
         print(">>> 正在生成回答...")
         print("-" * 50)
-        async for event in answer_stream(args.question, citations, ctx_text, branch, "cli_test_session"):
+        async for event in answer_stream(args.question, citations, ctx_text, branch,
+                                         "cli_test_session", grader_task=grader_task):
             if event["type"] == "token":
                 print(event["data"], end="", flush=True)
             # elif event["type"] == "citation":
@@ -286,7 +286,14 @@ export async function processChatStream(
             const data = JSON.parse(eventData);
 
             switch (eventType) {
+              case 'citations':
+                // 后端把整组引用合并为单个事件（一次 JSON 编码/一帧 SSE）
+                for (const citation of data) {
+                  onCitation(citation);
+                }
+                break;
               case 'citation':
+                // 兼容旧后端的逐条引用事件
                 onCitation(data);
                 break;
               case 'token':